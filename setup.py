@@ -25,6 +25,9 @@ setup(
         'receiver': [  # sms receiving
             'flask >= 0.10',
         ],
+        'numpy': [  # faster cost estimation
+            'numpy',
+        ],
         '_dev': ['wheel', 'nose', 'flask'],
     },
     test_suite='nose.collector',
@@ -4,9 +4,15 @@ import urllib
 import urllib2
 import re
 import math
+import json
+import time
 import binascii
+import threading
+from itertools import islice
+from contextlib import contextmanager
 
 from .const import Features
+from . import error
 
 
 class ClickatellApiError(RuntimeError):
@@ -15,10 +21,272 @@ class ClickatellApiError(RuntimeError):
         super(ClickatellApiError, self).__init__(message)
 
 
+def is_unicode(text):
+    """ Is the message sent as unicode (UCS-2)? Otherwise, it's sent in the GSM 7-bit alphabet.
+
+        :param text: Message text: str or unicode.
+        :rtype: bool
+    """
+    return len(text.encode('utf-8')) != len(text)
+
+
+def message_parts(text):
+    """ Get the number of parts the message is sent in
+
+        :param text: Message text: str or unicode.
+        :rtype: int
+    """
+    # Message length: 160 GSM 7bit chars || 70 UCS-2 chars
+    # Note: concatenation reduces each part by 7 GSM chars || 3 UCS-2 chars
+    if is_unicode(text):
+        # Chars beyond the BMP take two UCS-2 chars
+        n, single, multi = len(text.encode('UTF-16BE')) // 2, 70, 67
+    else:
+        # Chars of the GSM extension table take two GSM chars
+        n, single, multi = len(text) + sum(text.count(c) for c in '^{}\\[~]|'), 160, 153
+    return 1 if n <= single else int(math.ceil(n/float(multi)))
+
+
+#region Transports
+
+class ClickatellTransport(object):
+    """ Transport: the protocol used to deliver requests to Clickatell
+
+        Subclass it to plug in a custom transport.
+    """
+
+    #: Maximum number of recipients per `sendmsg` request
+    max_recipients = 1
+
+    def __init__(self, api):
+        """ Create a transport
+
+            :type api: ClickatellHttpApi
+            :param api: The client that uses the transport
+        """
+        self.api = api
+
+    def getbalance(self):
+        """ Query balance
+
+            :rtype: float
+        """
+        raise NotImplementedError
+
+    def sendmsg(self, to, text, params):
+        """ Send a message to a batch of recipients
+
+            :type to: list
+            :param to: Destination numbers: no more than :attr:`max_recipients`
+            :type text: str|unicode
+            :param text: Message text
+            :type params: dict
+            :param params: Message parameters, named as in the HTTP API
+            :rtype: list
+            :returns: List of (to, msgid, error) tuples, where `error` is a ClickatellApiError or None
+            :raises ClickatellApiError: Error that concerns the whole request
+        """
+        raise NotImplementedError
+
+    def querymsg(self, climsgid):
+        """ Find a sent message by its client message id
+
+            :param climsgid: Client message id
+            :rtype: str|None
+            :returns: Message id, or None if the message was never sent
+            :raises NotImplementedError: The transport can't find messages
+        """
+        raise NotImplementedError
+
+
+class HttpTransport(ClickatellTransport):
+    """ HTTP API transport: form-encoded requests to `/http/{method}`, plain-text responses """
+
+    # Recipients are sent as a comma-separated list, at most 100 of them
+    max_recipients = 100
+
+    #: Errors about the recipient rather than the request.
+    #: With a single recipient, Clickatell reports them without " To: <number>"
+    recipient_errors = (error.E105.code, error.E114.code, error.E121.code, error.E122.code, error.E128.code)
+
+    def getbalance(self):
+        response = self.api.api_request('getbalance')
+        m = re.match(r'^Credit: ([\d\.]+)$', response)
+        assert m is not None, 'Failed to parse response: {}'.format(response)
+        return float(m.group(1))
+
+    def sendmsg(self, to, text, params):
+        params = dict(params)
+        params['to'] = ','.join(to)
+
+        # Unicode message
+        if not is_unicode(text):
+            params['text'] = str(text)
+        else:
+            # Unicode message
+            params['unicode'] = 1
+            params['text'] = binascii.hexlify(text.encode('UTF-16BE'))  # Convert to UCS-2 HEX (utf-16 big-endian)
+
+        # Send it
+        # Not using `api_request()`: with multiple recipients, every line of the response may be an error
+        with self.api._limited():
+            response = self.api._authenticated_request('sendmsg', **params)
+
+            # Parse the response: one line per recipient.
+            # "ID: <msgid>" or "ERR: <code>, <message>", followed by " To: <number>" when there are multiple recipients
+            results = []
+            for line in response.strip().splitlines():
+                m = re.match(r'^(?:ID: (\S+)|ERR: (\d+), (.*?))(?: To: (\d+))?$', line.strip())
+                assert m is not None, 'Failed to parse response: {}'.format(response)
+                msgid, code, message, dst = m.groups()
+
+                if dst is None:
+                    # No recipient: the error applies to the whole request, unless it's about the single recipient
+                    if code is not None and (len(to) != 1 or int(code) not in self.recipient_errors):
+                        raise ClickatellApiError(code=int(code), message=message)
+                    assert len(to) == 1, 'Failed to parse response: {}'.format(response)
+                    dst = to[0]
+
+                results.append((
+                    dst,
+                    msgid,
+                    ClickatellApiError(code=int(code), message=message) if code is not None else None
+                ))
+        return results
+
+    def querymsg(self, climsgid):
+        try:
+            return self.api.querymsg(climsgid=climsgid)[0]
+        except ClickatellApiError as e:
+            if e.code == error.E104.code:  # Unknown client message ID
+                return None
+            raise
+
+
+class RestTransport(ClickatellTransport):
+    """ REST API transport: JSON requests to `/rest/...`, structured responses
+
+        Authenticates with the auth token given to :class:`ClickatellHttpApi`
+    """
+
+    max_recipients = 600
+
+    #: HTTP API parameter names mapped to their REST API counterparts.
+    #: Other parameters have no REST counterpart, and are rejected.
+    params_map = {
+        'from': 'from',
+        'mo': 'mo',
+        'escalate': 'escalate',
+        'callback': 'callback',
+        'climsgid': 'clientMessageId',
+        'validity': 'validityPeriod',
+        'deliv_time': 'deliveryTime',
+        'req_feat': 'requiredFeatures',
+        'queue': 'deliveryQueue',
+        'max_credits': 'maxCredits',
+    }
+
+    def _rest_request(self, verb, path, data=None):
+        """ Make a REST API request and return the decoded response
+
+            :rtype: dict
+        """
+        # Prepare the request
+        url = '{schema}://{host}/rest/{path}'.format(
+            schema='https' if self.api._https else 'http',
+            host=self.api._hostname,
+            path=path
+        )
+        req = urllib2.Request(url, json.dumps(data) if data is not None else None, {
+            'X-Version': '1',
+            'Content-Type': 'application/json',
+            'Accept': 'application/json',
+            'Authorization': 'Bearer {}'.format(self.api._token),
+        })
+        req.get_method = lambda: verb
+
+        # Request
+        try:
+            res = urllib2.urlopen(req)
+        except urllib2.HTTPError as e:
+            # Request errors come with a JSON body that describes them
+            try:
+                return json.load(e)
+            except ValueError:
+                raise e
+        return json.load(res)
+
+    def rest_request(self, verb, path, data=None):
+        """ Make a REST API request and get the response data.
+
+            This also handles errors reported by the Clickatell API
+
+            :raises HTTPError: Http error code
+            :raises URLError: Connection failed
+            :raises ClickatellApiError: Clickatell error
+            :rtype: dict
+        """
+        with self.api._limited():
+            response = self._rest_request(verb, path, data)
+
+            # Error?
+            if 'error' in response:
+                raise ClickatellApiError(code=int(response['error']['code']), message=response['error']['description'])
+            else:
+                return response['data']
+
+    def getbalance(self):
+        return float(self.rest_request('GET', 'account/balance')['balance'])
+
+    def sendmsg(self, to, text, params):
+        params = dict(params)
+        params.pop('concat', None)  # REST API concatenates on its own
+
+        # Delivery acknowledgements: requested with the callback type. 3: intermediate and final statuses
+        if params.pop('deliv_ack', None):
+            params.setdefault('callback', 3)
+
+        # Parameters
+        unknown = set(params) - set(self.params_map)
+        if unknown:
+            raise ValueError('Parameters not supported by the REST API: {}'.format(', '.join(sorted(unknown))))
+        data = dict((self.params_map[k], v) for k, v in params.items())
+        data['to'] = list(to)
+        data['text'] = text
+        if is_unicode(text):
+            data['unicode'] = 1
+
+        # Send it, collect per-recipient results
+        results = []
+        for m in self.rest_request('POST', 'message', data)['message']:
+            if m['accepted']:
+                results.append((m['to'], m['apiMessageId'], None))
+            else:
+                results.append((m['to'], None, ClickatellApiError(code=int(m['error']['code']), message=m['error']['description'])))
+        return results
+
+    def querymsg(self, climsgid):
+        try:
+            return self.rest_request('GET', 'message/{}'.format(urllib.quote(climsgid)))['apiMessageId']
+        except ClickatellApiError as e:
+            if e.code == error.E104.code:  # Unknown client message ID
+                return None
+            raise
+
+#endregion
+
+
 class ClickatellHttpApi(object):
     """ Clickatell HTTP API client """
 
-    def __init__(self, api_id, user, password, https=False):
+    #: Transports available by name
+    transports = {
+        'http': HttpTransport,
+        'rest': RestTransport,
+    }
+
+    def __init__(self, api_id=None, user=None, password=None, https=False, transport='http', token=None,
+                 session=False, keepalive=600):
         """ Create an authenticated client
 
             :param api_id: Authentication: API ID
@@ -26,17 +294,62 @@ class ClickatellHttpApi(object):
             :param password: Authentication: password
             :type https: bool
             :param https: Use HTTPS protocol for requests?
+            :type transport: str|type
+            :param transport: Transport for sending messages: 'http', 'rest', or a :class:`ClickatellTransport` subclass
+            :param token: Authentication: REST API auth token
+            :type session: bool
+            :param session: Session mode: authenticate once, then send the session id only.
+                The session is shared between threads, and is renewed when it expires.
+            :type keepalive: int
+            :param keepalive: Session mode: ping an idle session every this many seconds to keep it alive
         """
         self._auth = dict(
             api_id=api_id,
             user=user,
             password=password
         )
+        self._token = token
         self._https = https
 
         #: Provider API endpoint
         self._hostname = 'api.clickatell.com'
 
+        #: Session mode?
+        self.session = session
+        self.keepalive = keepalive
+        self._session_id = None
+        self._session_used = 0
+        self._session_lock = threading.Lock()
+        self._keepalive = None  # started with the first session
+        self._closed = threading.Event()
+
+        #: Concurrency limiter for requests, if any
+        self.limiter = None
+        " :type: smsframework_clickatell.concurrency.AdaptiveConcurrencyLimiter "
+
+        #: Transport used for sending messages
+        self.transport = self.transport_class(transport)(self)
+        " :type: ClickatellTransport "
+
+    @classmethod
+    def transport_class(cls, transport):
+        """ Get the transport class
+
+            :type transport: str|type
+            :param transport: Transport name, or a :class:`ClickatellTransport` subclass
+            :rtype: type
+        """
+        return transport if isinstance(transport, type) else cls.transports[transport]
+
+    @contextmanager
+    def _limited(self):
+        """ Context manager: make a request within the concurrency limit, if any """
+        if self.limiter is None:
+            yield
+        else:
+            with self.limiter.request():
+                yield
+
     def _api_request(self, method, **params):
         """ Make an API request and return the result
 
@@ -48,16 +361,80 @@ class ClickatellHttpApi(object):
             host=self._hostname,
             method=method
         )
-        data = {}
-        data.update(self._auth)
-        data.update(params)
-        post = urllib.urlencode(data)
+        post = urllib.urlencode(params)
 
         # Request
         req = urllib2.Request(url, post)
         res = urllib2.urlopen(req)
         return res.read()
 
+    def _authenticated_request(self, method, **params):
+        """ Make an authenticated API request and return the result
+
+            Authenticates with the credentials, or, in session mode, with the session id.
+            When the session has expired (E003, E005), it's renewed, and the request is repeated.
+
+            :rtype: str
+        """
+        if not self.session:
+            return self._api_request(method, **dict(self._auth, **params))
+
+        session_id = self._session_id or self._renew_session(None)
+        response = self._api_request(method, session_id=session_id, **params)
+        if re.match(r'^ERR: 0*(3|5),', response):  # Session ID expired, Missing session ID
+            session_id = self._renew_session(session_id)
+            response = self._api_request(method, session_id=session_id, **params)
+        self._session_used = time.time()
+        return response
+
+    def _renew_session(self, expired):
+        """ Authenticate and get a new session id
+
+            Single-flight: when many threads find the session expired, only one of them authenticates,
+            and the others use the new session.
+
+            :param expired: The session id that has expired, or None
+            :rtype: str
+            :returns: The new session id
+            :raises ClickatellApiError: Authentication failed
+        """
+        with self._session_lock:
+            if self._session_id != expired:
+                return self._session_id  # already renewed
+
+            response = self._api_request('auth', **self._auth)
+            m = re.match(r'^ERR: (\d+), (.*)', response)
+            if m:
+                raise ClickatellApiError(code=int(m.group(1)), message=m.group(2))
+            m = re.match(r'^OK: (\S+)$', response.strip())
+            assert m is not None, 'Failed to parse response: {}'.format(response)
+
+            self._session_id = m.group(1)
+            self._session_used = time.time()
+
+            # Keep it alive
+            if self._keepalive is None:
+                self._keepalive = threading.Thread(target=self._session_keepalive)
+                self._keepalive.daemon = True
+                self._keepalive.start()
+            return self._session_id
+
+    def _session_keepalive(self):
+        """ Thread: ping the session when it's idle, so it does not expire """
+        while not self._closed.wait(self.keepalive / 10.0):
+            if self._session_id is None or time.time() - self._session_used < self.keepalive:
+                continue
+            try:
+                self._authenticated_request('ping')
+            except Exception:
+                pass  # will be renewed on the next request
+
+    def close(self):
+        """ Stop the session keepalive, if running """
+        self._closed.set()
+        if self._keepalive is not None and self._keepalive is not threading.current_thread():
+            self._keepalive.join()
+
     def api_request(self, method, **params):
         """ Make a custom request to Clickatell and get the response object.
 
@@ -70,14 +447,15 @@ class ClickatellHttpApi(object):
             :raises URLError: Connection failed
             :raises ClickatellApiError: Clickatell error
         """
-        response = self._api_request(method, **params)
+        with self._limited():
+            response = self._authenticated_request(method, **params)
 
-        # Error?
-        m = re.match(r'^ERR: (\d+), (.*)', response)
-        if m:
-            raise ClickatellApiError(code=int(m.group(1)), message=m.group(2))
-        else:
-            return response
+            # Error?
+            m = re.match(r'^ERR: (\d+), (.*)', response)
+            if m:
+                raise ClickatellApiError(code=int(m.group(1)), message=m.group(2))
+            else:
+                return response
 
     def getbalance(self):
         """ Query balance
@@ -85,10 +463,7 @@ class ClickatellHttpApi(object):
             :rtype: float
             :returns: the number of credits available on this particular account.
         """
-        response = self.api_request('getbalance')
-        m = re.match(r'^Credit: ([\d\.]+)$', response)
-        assert m is not None, 'Failed to parse response: {}'.format(response)
-        return float(m.group(1))
+        return self.transport.getbalance()
 
     def sendmsg(self, to, text, **params):
         """ Send SMS message
@@ -108,33 +483,69 @@ class ClickatellHttpApi(object):
             :param unicode: Enable unicode messages. If set to 1, the `text` should contain 2-byte unicode. Default: 0
             :param validity: Message validity (expire) period in minutes. Default: None
             :param req_feat: Required features list for the gateway: or'ed constants. see :class:`Features`
+            :param climsgid: Client message id: reported back with status reports, see :class:`ClientMessageIds`
 
             :rtype: str
             :returns: Message id
         """
-        # Recipient
-        # TODO: Clickatell allows to specify multiple recipients, ','-separated. Implement it! ..and handle the multiple responses
-        params['to'] = to
+        [(to, msgid, e)] = self.sendmsg_multi([to], text, **params)
+        if e is not None:
+            raise e
+        return msgid
+
+    def sendmsg_multi(self, to, text, **params):
+        """ Send SMS message to multiple recipients
 
+            Recipients are sent in batches of :attr:`ClickatellTransport.max_recipients`.
+            Errors that concern a single recipient are reported in the results; errors of a whole batch are raised.
+            The raised error has the `results` attribute: results of the batches sent before the failure.
+            Recipients not found there were not sent to (or, on a connection error, might have been).
+
+            :type to: iterable
+            :param to: Destination numbers, digits only
+            :param text: Message text: str or unicode.
+            :param params: Message parameters. See :meth:`sendmsg`
+
+            :rtype: list
+            :returns: List of (to, msgid, error) tuples, where `error` is a ClickatellApiError or None
+        """
         # Param: `concat`: enable message concatenation.
-        # Message length: 160 7bit chars || 140 8bit chars
-        # Note: concatenation reduces each message by 7 chars
-        concat_parts = (lambda n: 1 if n <= 140 else math.ceil(n/float(140-7)))(len(text.encode('utf-8')))
-        if concat_parts > 1:
+        if message_parts(text) > 1:
             params['concat'] = 1
 
         # CHECKME: seems like req_feat requires FEAT_DELIVACK to be set for acknowledgements. Check it!
 
-        # Unicode message
-        if len(text.encode('utf-8')) == len(text):
-            params['text'] = str(text)
-        else:
-            # Unicode message
-            params['unicode'] = 1
-            params['text'] = binascii.hexlify(text.encode('UTF-16BE'))  # Convert to UCS-2 HEX (utf-16 big-endian)
+        # Send in batches
+        results = []
+        to = iter(to)
+        while True:
+            batch = list(islice(to, self.transport.max_recipients))
+            if not batch:
+                break
+            try:
+                results.extend(self.transport.sendmsg(batch, text, params))
+            except Exception as e:
+                e.results = results  # do not lose the messages already sent
+                raise
+        return results
+
+    def querymsg(self, apimsgid=None, climsgid=None):
+        """ Query message status
+
+            See :meth:`ClickatellHttpApi.api_request` for the list of raised exceptions.
+
+            :param apimsgid: Message id, as returned by :meth:`sendmsg`
+            :param climsgid: Client message id, as provided to :meth:`sendmsg`
+            :rtype: (str, int)
+            :returns: (message id, status code)
+        """
+        params = {}
+        if apimsgid:
+            params['apimsgid'] = apimsgid
+        if climsgid:
+            params['climsgid'] = climsgid
 
-        # Send it, parse the response
-        response = self.api_request('sendmsg', **params)
-        m = re.match(r'^ID: (.*)$', response)
+        response = self.api_request('querymsg', **params)
+        m = re.match(r'^ID: (\S+) Status: (\d+)', response)
         assert m is not None, 'Failed to parse response: {}'.format(response)
-        return m.group(1)
+        return m.group(1), int(m.group(2))
@@ -0,0 +1,271 @@
+""" Blocklist of destinations that cannot receive messages """
+
+import time
+import mmap
+import struct
+import bisect
+import threading
+from array import array
+
+from . import error
+
+
+def _key(number):
+    """ Get the key of a number: '1' and the digits, as a double
+
+        The leading '1' keeps the leading zeros: '0044...' and '44...' are different numbers.
+        Exact for up to 15 digits, which is the E.164 maximum.
+
+        :type number: str
+        :rtype: float
+    """
+    return float('1' + number)
+
+
+def _number(key):
+    """ Get the number back from its key
+
+        :type key: float
+        :rtype: str
+    """
+    return ('%d' % key)[1:]
+
+
+class Blocklist(object):
+    """ Compact set of blocked destination numbers
+
+        Numbers are stored in sorted arrays, together with the error code and the expiration time:
+        13 bytes per number. New numbers are buffered and merged into the arrays in batches.
+
+        Numbers are stored as doubles, see :func:`_key`.
+    """
+
+    #: The longest number that can be stored
+    max_digits = 15
+
+    #: Error codes that block a destination
+    codes = (error.E121.code, error.E122.code, error.E128.code)
+
+    def __init__(self, ttl=None, buffer_size=1000):
+        """ Create the blocklist
+
+            :type ttl: int|None
+            :param ttl: Time to keep numbers blocked, seconds. None: forever
+            :type buffer_size: int
+            :param buffer_size: The number of new numbers to buffer before merging them into the arrays
+        """
+        self.ttl = ttl
+        self.buffer_size = buffer_size
+
+        self._lock = threading.Lock()
+        self._numbers = array('d')
+        self._expires = array('I')  # 0: never
+        self._codes = array('B')
+        self._buffer = {}  # number -> (code, expires)
+
+    def __len__(self):
+        with self._lock:
+            if self._buffer:
+                self._merge()
+            return len(self._numbers)
+
+    def __contains__(self, number):
+        return self.lookup(number) is not None
+
+    def _merge(self):
+        """ Merge the buffer into the arrays, drop expired numbers """
+        now = time.time()
+        buffer = sorted(self._buffer.items())
+        self._buffer = {}
+
+        # Merge two sorted sequences. The buffer overrides.
+        numbers, expires, codes = array('d'), array('I'), array('B')
+        i, j = 0, 0
+        while i < len(self._numbers) or j < len(buffer):
+            if j == len(buffer) or (i < len(self._numbers) and self._numbers[i] < buffer[j][0]):
+                number, code, expire = self._numbers[i], self._codes[i], self._expires[i]
+                i += 1
+            else:
+                number, (code, expire) = buffer[j]
+                j += 1
+                if i < len(self._numbers) and self._numbers[i] == number:
+                    i += 1
+            if code and (not expire or expire > now):
+                numbers.append(number)
+                codes.append(code)
+                expires.append(expire)
+        self._numbers, self._expires, self._codes = numbers, expires, codes
+
+    def add(self, number, code, expires=None):
+        """ Block a number
+
+            :type number: str
+            :param number: Destination number, digits only
+            :type code: int
+            :param code: Error code that sending to the number fails with
+            :type expires: int|None
+            :param expires: Expiration time, unix timestamp. Default: now + ttl
+            :rtype: bool
+            :returns: Whether the number was blocked: numbers longer than :attr:`max_digits` are not
+        """
+        if len(number) > self.max_digits:
+            return False
+        if expires is None:
+            expires = int(time.time() + self.ttl) if self.ttl else 0
+        with self._lock:
+            self._buffer[_key(number)] = (code, int(expires))
+            if len(self._buffer) >= self.buffer_size:
+                self._merge()
+        return True
+
+    def discard(self, number):
+        """ Unblock a number
+
+            :type number: str
+            :param number: Destination number, digits only
+        """
+        with self._lock:
+            self._buffer[_key(number)] = (0, 0)  # dropped on merge
+            self._merge()
+
+    def lookup(self, number):
+        """ Look up a number
+
+            :type number: str
+            :param number: Destination number, digits only
+            :rtype: int|None
+            :returns: Error code, or None when the number is not blocked
+        """
+        if not number or len(number) > self.max_digits:
+            return None
+        n = _key(number)
+        with self._lock:
+            code, expires = self._buffer.get(n, (None, None))
+            if code is None:
+                i = bisect.bisect_left(self._numbers, n)
+                if i == len(self._numbers) or self._numbers[i] != n:
+                    return None
+                code, expires = self._codes[i], self._expires[i]
+        if not code or (expires and expires <= time.time()):
+            return None
+        return code
+
+    def items(self):
+        """ Get the blocked numbers
+
+            :rtype: list
+            :returns: [ (number, code, expires) ]
+        """
+        with self._lock:
+            self._merge()
+            return zip(map(_number, self._numbers), self._codes, self._expires)
+
+    def update(self, items):
+        """ Block many numbers
+
+            :type items: iterable
+            :param items: (number, code, expires) tuples, as returned by :meth:`items`
+        """
+        with self._lock:
+            for number, code, expires in items:
+                if len(number) <= self.max_digits:
+                    self._buffer[_key(number)] = (int(code), int(expires))
+            self._merge()
+
+    #region Import/Export
+
+    def dump(self, f):
+        """ Export to a text file: a "number,code,expires" line per number
+
+            :type f: file
+        """
+        for item in self.items():
+            f.write('{},{},{}\n'.format(*item))
+
+    def load(self, f):
+        """ Import from a text file written by :meth:`dump`
+
+            :type f: file
+        """
+        self.update(line.strip().split(',') for line in f if line.strip())
+
+    def save(self, path):
+        """ Save to a binary file, to be shared with :class:`MappedBlocklist`
+
+            :type path: str
+        """
+        with self._lock:
+            self._merge()
+            with open(path, 'wb') as f:
+                f.write(MappedBlocklist.header.pack(MappedBlocklist.magic, len(self._numbers)))
+                f.write(self._numbers.tostring())
+                f.write(self._expires.tostring())
+                f.write(self._codes.tostring())
+
+    #endregion
+
+
+class MappedBlocklist(object):
+    """ Read-only blocklist, memory-mapped from a file written by :meth:`Blocklist.save`
+
+        The file is shared by all processes that map it: worker processes look numbers up without loading the list.
+        File layout: header, number keys (doubles), expiration times (uint32), error codes (uint8). Native byte order.
+    """
+
+    magic = 'CLKBLK02'
+    header = struct.Struct('=8sQ')
+
+    def __init__(self, path):
+        """ Map the file
+
+            :type path: str
+        """
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._len = self.header.unpack_from(self._mm, 0)
+        assert magic == self.magic, 'Not a blocklist file: {}'.format(path)
+
+        self._numbers_at = self.header.size
+        self._expires_at = self._numbers_at + 8 * self._len
+        self._codes_at = self._expires_at + 4 * self._len
+
+    def __len__(self):
+        return self._len
+
+    def __contains__(self, number):
+        return self.lookup(number) is not None
+
+    def _number(self, i):
+        return struct.unpack_from('=d', self._mm, self._numbers_at + 8 * i)[0]
+
+    def lookup(self, number):
+        """ Look up a number
+
+            :type number: str
+            :param number: Destination number, digits only
+            :rtype: int|None
+            :returns: Error code, or None when the number is not blocked
+        """
+        if not number or len(number) > Blocklist.max_digits:
+            return None
+        n = _key(number)
+
+        # Binary search
+        lo, hi = 0, self._len
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._number(mid) < n:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self._len or self._number(lo) != n:
+            return None
+
+        expires = struct.unpack_from('=I', self._mm, self._expires_at + 4 * lo)[0]
+        if expires and expires <= time.time():
+            return None
+        return struct.unpack_from('=B', self._mm, self._codes_at + lo)[0]
+
+    def close(self):
+        """ Unmap the file """
+        self._mm.close()
@@ -0,0 +1,226 @@
+""" Multi-process campaign executor """
+
+import re
+import time
+import threading
+import multiprocessing
+from Queue import Empty
+from itertools import islice
+from urllib2 import URLError, HTTPError
+
+from smsframework import exc
+from . import error
+from .api import ClickatellHttpApi, ClickatellApiError
+from .ratelimit import TokenBucket
+from .blocklist import MappedBlocklist
+
+
+def _backoff_until(message, default):
+    """ Get the time to back off until from the E130 error message
+
+        :rtype: float
+    """
+    m = re.search(r'\b(\d{10})\b', message)
+    return float(m.group(1)) if m else time.time() + default
+
+
+def _error_tuple(e):
+    """ Convert an error into a picklable tuple, see :func:`_worker`
+
+        :rtype: tuple|None
+    """
+    if e is None:
+        return None
+    if isinstance(e, ClickatellApiError):
+        return ('api', e.code, e.message)
+    if isinstance(e, HTTPError):
+        return ('http', str(e))
+    if isinstance(e, URLError):
+        return ('connection', str(e.reason))
+    return ('error', repr(e))
+
+
+def _worker(api_config, bucket, backoff, blocklist, tasks, results, text, params):
+    """ Worker process: send the message to batches of recipients from `tasks`, report to `results`
+
+        Recipients from the `blocklist` file are reported as failed without a request.
+
+        Results are reported as lists of (to, msgid, error) tuples, where `error` is a picklable tuple:
+        ('api', code, message), ('blocklist', code), ('http', message), ('connection', message), ('error', message),
+        or None.
+        When the worker fails (e.g. the blocklist file can't be mapped), ('failed', message) is reported.
+        A None is reported on exit.
+    """
+    api = None
+    try:
+        api = ClickatellHttpApi(**api_config)
+        blocklist = MappedBlocklist(blocklist) if blocklist else None
+
+        for batch in iter(tasks.get, None):
+            # Blocked recipients
+            if blocklist is not None:
+                codes = [blocklist.lookup(to) for to in batch]
+                if any(codes):
+                    results.put([(to, None, ('blocklist', code)) for to, code in zip(batch, codes) if code])
+                    batch = [to for to, code in zip(batch, codes) if not code]
+
+            while batch:
+                bucket.acquire(len(batch))
+                try:
+                    sent = api.sendmsg_multi(batch, text, **params)
+                except Exception as e:
+                    # The recipients not sent to share the error
+                    sent = list(getattr(e, 'results', []))
+                    reported = set(to for to, msgid, _ in sent)
+                    sent.extend((to, None, e) for to in batch if to not in reported)
+
+                # Limit exceeded: everybody backs off, retry
+                limited = [e for to, msgid, e in sent if isinstance(e, ClickatellApiError) and e.code == error.E130.code]
+                if limited:
+                    bucket.backoff(_backoff_until(limited[0].message, backoff))
+                batch = [to for to, msgid, e in sent if e in limited]
+                sent = [(to, msgid, e) for to, msgid, e in sent if e not in limited]
+
+                if sent:
+                    results.put([(to, msgid, _error_tuple(e)) for to, msgid, e in sent])
+    except Exception as e:
+        results.put(('failed', repr(e)))
+    finally:
+        if api is not None:
+            api.close()
+        results.put(None)
+
+
+class CampaignExecutor(object):
+    """ Sends a message to a stream of recipients with a pool of worker processes
+
+        Recipients are split into batches and shared between the workers.
+        All workers draw from one token bucket (a token per recipient), so the pool never exceeds the account limit,
+        and back off together when Clickatell reports E130.
+
+        A failed worker, or a worker killed from outside, stops the campaign with a :class:`ProviderError`.
+    """
+
+    #: Time to wait for results before checking on the workers, seconds
+    poll = 1.0
+
+    def __init__(self, api_config, processes=4, rate=10, burst=None, backoff=60, blocklist=None, failed=None):
+        """ Create the executor
+
+            :type api_config: dict
+            :param api_config: :class:`ClickatellHttpApi` arguments
+            :type processes: int
+            :param processes: The number of worker processes
+            :type rate: float
+            :param rate: Messages per second, for all workers together
+            :type burst: int
+            :param burst: Burst size. Default: one second worth of messages
+            :type backoff: int
+            :param backoff: Backoff on E130 when the error does not tell when the limit resets, seconds
+            :type blocklist: str|None
+            :param blocklist: Path to a blocklist file, see :meth:`Blocklist.save`. Blocked recipients are skipped.
+            :type failed: callable|None
+            :param failed: failed(to, code): called for every recipient rejected by Clickatell, as results arrive.
+                See :meth:`ClickatellProvider.failed`
+        """
+        self.api_config = api_config
+        self.processes = processes
+        self.backoff = backoff
+        self.blocklist = blocklist
+        self.failed = failed
+
+        #: Global rate limiter
+        self.bucket = TokenBucket(rate, burst)
+
+        #: Recipients per batch
+        transport = ClickatellHttpApi.transport_class(api_config.get('transport', 'http'))
+        self.batch_size = min(transport.max_recipients, self.bucket.burst)
+
+    def _error(self, e):
+        """ Convert an error reported by a worker into an exception
+
+            :rtype: Exception|None
+        """
+        if e is None:
+            return None
+        if e[0] == 'api':
+            return error.ClickatellProviderError(e[1], e[2])
+        if e[0] == 'blocklist':
+            return error.ClickatellProviderError(e[1], 'Blocklist')
+        if e[0] == 'http':
+            return exc.MessageSendError(e[1])
+        if e[0] == 'connection':
+            return exc.ConnectionError(e[1])
+        return exc.ProviderError(e[1])
+
+    def run(self, recipients, text, **params):
+        """ Send a message to the recipients
+
+            Results are streamed as they arrive, in no particular order.
+
+            :type recipients: iterable
+            :param recipients: Destination numbers, digits only
+            :param text: Message text: str or unicode.
+            :param params: Message parameters. See :meth:`ClickatellHttpApi.sendmsg`
+            :rtype: generator
+            :returns: (to, msgid, error) tuples, where `error` is a :class:`smsframework.exc.ProviderError` or None
+            :raises ProviderError: A worker has failed, or has been killed
+        """
+        tasks = multiprocessing.Queue(self.processes * 2)
+        results = multiprocessing.Queue()
+        workers = [
+            multiprocessing.Process(
+                target=_worker,
+                args=(self.api_config, self.bucket, self.backoff, self.blocklist, tasks, results, text, params)
+            ) for i in range(self.processes)
+        ]
+        for w in workers:
+            w.daemon = True
+            w.start()
+
+        # Feed the recipients from a thread: results are streamed while the recipients are being read
+        def feed():
+            recipients_iter = iter(recipients)
+            while True:
+                batch = list(islice(recipients_iter, self.batch_size))
+                if not batch:
+                    break
+                tasks.put(batch)
+            for w in workers:
+                tasks.put(None)
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+        feeder.start()
+
+        # Collect the results
+        running = len(workers)
+        stalled = False
+        try:
+            while running:
+                try:
+                    res = results.get(timeout=self.poll)
+                except Empty:
+                    # Workers gone without reporting their exit: killed from outside.
+                    # Reports are flushed before a worker exits, so give them one more poll to arrive.
+                    if sum(w.exitcode is not None for w in workers) > len(workers) - running:
+                        if stalled:
+                            raise exc.ProviderError('Campaign worker killed, exit codes: {}'.format(
+                                [w.exitcode for w in workers]))
+                        stalled = True
+                    continue
+                stalled = False
+
+                if res is None:
+                    running -= 1
+                    continue
+                if isinstance(res, tuple):
+                    raise exc.ProviderError('Campaign worker failed: {}'.format(res[1]))
+                for to, msgid, e in res:
+                    if e is not None and e[0] == 'api' and self.failed is not None:
+                        self.failed(to, e[1])
+                    yield to, msgid, self._error(e)
+        finally:
+            for w in workers:
+                if w.is_alive():
+                    w.terminate()
+                w.join()
@@ -0,0 +1,156 @@
+""" Adaptive concurrency control """
+
+import time
+import socket
+import threading
+from collections import deque
+from contextlib import contextmanager
+from urllib2 import URLError, HTTPError
+
+from . import error
+from .api import ClickatellApiError
+
+
+class AdaptiveConcurrencyLimiter(object):
+    """ Adaptive limit of concurrent requests: additive increase, multiplicative decrease (AIMD)
+
+        * While requests are healthy, the limit grows by `increase` per limit-worth of requests, i.e. about once per
+          round trip. Healthy: faster than `latency`, and the recent error rate is below `error_rate`.
+        * On overload: E130, E901, HTTP 5xx, timeouts, or responses slower than `latency`,
+          the limit is multiplied by `decrease`. Overloads of requests started before the last decrease are ignored,
+          so a burst of failures from one round trip cuts the limit once.
+
+        Every change of the limit is recorded in :attr:`history`.
+    """
+
+    def __init__(self, initial=4, min_limit=1, max_limit=64, increase=1, decrease=0.5, latency=None, error_rate=0.1, history=1000):
+        """ Create the limiter
+
+            :type initial: int
+            :param initial: Initial limit
+            :type min_limit: int
+            :param min_limit: The lowest limit
+            :type max_limit: int
+            :param max_limit: The highest limit
+            :type increase: float
+            :param increase: Additive increase, per round trip
+            :type decrease: float
+            :param decrease: Multiplicative decrease factor: 0..1
+            :type latency: float|None
+            :param latency: Slower responses count as overload, seconds. None: no latency threshold
+            :type error_rate: float
+            :param error_rate: The limit does not grow while the error rate is higher: 0..1
+            :type history: int
+            :param history: The number of limit changes to remember
+        """
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.latency = latency
+        self.max_error_rate = error_rate
+
+        #: History of limit changes: [ (timestamp, limit, reason) ]
+        self.history = deque(maxlen=history)
+
+        #: Recent error rate: exponentially weighted, over about 20 requests
+        self.error_rate = 0.0
+
+        self._limit = float(initial)
+        self._inflight = 0
+        self._decreased = 0.0
+        self._cond = threading.Condition()
+
+    @property
+    def limit(self):
+        """ Current limit
+
+            :rtype: int
+        """
+        return int(self._limit)
+
+    @property
+    def inflight(self):
+        """ The number of requests in flight
+
+            :rtype: int
+        """
+        return self._inflight
+
+    #: Clickatell errors that signal overload: E130 Maximum MT limit exceeded, E901 Internal error.
+    #: Other errors concern the request or its destination (e.g. E114 Cannot route message).
+    overload_codes = (error.E130.code, error.E901.code)
+
+    @classmethod
+    def is_overload(cls, e):
+        """ Does the error signal overload?
+
+            :type e: Exception
+            :rtype: bool
+        """
+        if isinstance(e, (ClickatellApiError, error.ClickatellProviderError)):
+            return e.code in cls.overload_codes
+        if isinstance(e, HTTPError):
+            return e.code >= 500
+        if isinstance(e, URLError):
+            return isinstance(e.reason, socket.timeout)
+        return isinstance(e, socket.timeout)
+
+    def acquire(self):
+        """ Wait for a free slot
+
+            :rtype: float
+            :returns: Request start time, for :meth:`release`
+        """
+        with self._cond:
+            while self._inflight >= self.limit:
+                self._cond.wait()
+            self._inflight += 1
+        return time.time()
+
+    def release(self, started, failed=False, overload=False):
+        """ Free the slot and adjust the limit
+
+            :type started: float
+            :param started: Request start time, as returned by :meth:`acquire`
+            :type failed: bool
+            :param failed: Has the request failed? Counts towards the error rate
+            :type overload: bool
+            :param overload: Has the request failed because of overload?
+        """
+        with self._cond:
+            self._inflight -= 1
+            now = time.time()
+            self.error_rate += ((1.0 if failed or overload else 0.0) - self.error_rate) / 20
+
+            # Overload: decrease
+            slow = self.latency is not None and now - started > self.latency
+            if overload or slow:
+                if started >= self._decreased:
+                    self._decreased = now
+                    self._set_limit(max(self.min_limit, self._limit * self.decrease), 'overload' if overload else 'latency', now)
+            # Healthy: increase
+            elif self.error_rate < self.max_error_rate:
+                self._set_limit(min(self.max_limit, self._limit + float(self.increase) / self._limit), 'healthy', now)
+
+            self._cond.notify_all()
+
+    def _set_limit(self, limit, reason, now):
+        """ Change the limit, record the change """
+        if int(limit) != int(self._limit):
+            self.history.append((now, int(limit), reason))
+        self._limit = limit
+
+    @contextmanager
+    def request(self):
+        """ Context manager: run a request within the limit """
+        started = self.acquire()
+        try:
+            yield
+        except Exception as e:
+            # Errors reported by Clickatell are valid responses, unless they signal overload
+            overload = self.is_overload(e)
+            self.release(started, failed=overload or not isinstance(e, ClickatellApiError), overload=overload)
+            raise
+        else:
+            self.release(started)
@@ -0,0 +1,127 @@
+""" Campaign cost estimation """
+
+from itertools import islice
+
+from .api import message_parts, is_unicode
+
+try:
+    import numpy
+except ImportError:  # optional: faster aggregation
+    numpy = None
+
+
+class CostEstimator(object):
+    """ Campaign cost estimator
+
+        Counts message parts for many (destination, text) pairs, and prices them with a pricing table:
+        credits per message part, by destination prefix. The longest matching prefix wins.
+
+        Pairs are processed in chunks, so memory does not grow with the campaign size.
+        Parts are counted once per distinct text, and prefixes are matched once per distinct number prefix.
+        With NumPy installed, the per-prefix sums of a chunk are computed with `numpy.bincount`.
+    """
+
+    def __init__(self, pricing, default=None, chunk_size=100000):
+        """ Create the estimator
+
+            :type pricing: dict
+            :param pricing: Credits per message part, by destination prefix: { '380': 0.8, '1': 1.0, ... }
+            :type default: float|None
+            :param default: Credits per message part for destinations not in the table.
+                None: such messages are not priced, and are counted as 'unpriced'
+            :type chunk_size: int
+            :param chunk_size: The number of pairs to process at once
+        """
+        self.pricing = pricing
+        self.default = default
+        self.chunk_size = chunk_size
+        self._prefix_lengths = sorted(set(len(p) for p in pricing), reverse=True)
+
+    def _match(self, number):
+        """ Find the longest pricing prefix of the number
+
+            :rtype: str|None
+        """
+        for n in self._prefix_lengths:
+            if number[:n] in self.pricing:
+                return number[:n]
+        return None
+
+    def estimate(self, messages, balance=None):
+        """ Estimate the cost of sending the messages
+
+            :type messages: iterable
+            :param messages: (destination, text) pairs. Destinations: digits only
+            :type balance: float|None
+            :param balance: Account balance to compare the cost with
+            :rtype: dict
+            :returns: {
+                    'messages': int, 'parts': int, 'credits': float,
+                    'unicode': int,  # unicode messages
+                    'unpriced': int,  # messages to destinations not in the pricing table
+                    'prefixes': { prefix|None: {'messages': int, 'parts': int, 'credits': float} },
+                    'balance': float, 'sufficient': bool,  # when the balance is given
+                }
+        """
+        # Aggregation keys: pricing prefixes, index 0 for destinations not in the table
+        prefixes = [None] + sorted(self.pricing)
+        index = dict((p, i) for i, p in enumerate(prefixes))
+        prices = [self.default or 0.0] + [self.pricing[p] for p in prefixes[1:]]
+        max_prefix = self._prefix_lengths[0] if self._prefix_lengths else 0
+
+        counts = [0] * len(prefixes)
+        parts = [0] * len(prefixes)
+        unicode_count = 0
+        texts = {}  # text -> (parts, unicode?)
+        matches = {}  # number prefix -> prefix index
+
+        messages = iter(messages)
+        while True:
+            chunk = list(islice(messages, self.chunk_size))
+            if not chunk:
+                break
+
+            # Per-message: prefix index, parts
+            chunk_index, chunk_parts = [], []
+            if len(texts) > self.chunk_size:
+                texts.clear()  # personalized texts: do not let the cache grow
+            for dst, text in chunk:
+                t = texts.get(text)
+                if t is None:
+                    t = texts[text] = (message_parts(text), is_unicode(text))
+                i = matches.get(dst[:max_prefix])
+                if i is None:
+                    i = matches[dst[:max_prefix]] = index[self._match(dst)]
+                chunk_index.append(i)
+                chunk_parts.append(t[0])
+                unicode_count += t[1]
+
+            # Aggregate by prefix
+            if numpy is not None:
+                chunk_index = numpy.array(chunk_index, dtype=numpy.intp)
+                chunk_counts = numpy.bincount(chunk_index, minlength=len(prefixes))
+                chunk_parts = numpy.bincount(chunk_index, weights=chunk_parts, minlength=len(prefixes))
+                counts = [a + int(b) for a, b in zip(counts, chunk_counts)]
+                parts = [a + int(b) for a, b in zip(parts, chunk_parts)]
+            else:
+                for i, p in zip(chunk_index, chunk_parts):
+                    counts[i] += 1
+                    parts[i] += p
+
+        # Report
+        ret = {
+            'messages': sum(counts),
+            'parts': sum(parts),
+            'credits': sum(p * price for p, price in zip(parts, prices)),
+            'unicode': unicode_count,
+            'unpriced': counts[0] if self.default is None else 0,
+            'prefixes': dict(
+                (prefix, {'messages': n, 'parts': p, 'credits': p * price})
+                for prefix, n, p, price in zip(prefixes, counts, parts, prices)
+                if n
+            ),
+        }
+        if balance is not None:
+            ret['balance'] = balance
+            ret['sufficient'] = balance >= ret['credits']
+        return ret
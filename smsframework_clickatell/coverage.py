@@ -0,0 +1,157 @@
+""" Route coverage cache """
+
+import time
+import threading
+
+from . import error
+from .api import ClickatellApiError
+
+
+class PrefixTrie(object):
+    """ Trie of number prefixes with expiring values
+
+        Nodes are dicts keyed by digit. A node's value is stored under the None key as (value, expires).
+        Thread-safe.
+    """
+
+    def __init__(self):
+        self._root = {}
+        self._lock = threading.Lock()
+
+    def set(self, prefix, value, expires):
+        """ Set the value of a prefix
+
+            :type prefix: str
+            :param prefix: Number prefix, digits only
+            :param value: The value
+            :type expires: float
+            :param expires: Expiration time, unix timestamp
+        """
+        with self._lock:
+            node = self._root
+            for d in prefix:
+                node = node.setdefault(d, {})
+            node[None] = (value, expires)
+
+    def lookup(self, number, now=None):
+        """ Get the value of the longest prefix of the number
+
+            Expired values are removed on the way, and so are the nodes left empty.
+
+            :type number: str
+            :param number: The number, digits only
+            :rtype: *
+            :returns: The value, or None
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            node, found, path = self._root, None, []
+            for d in number:
+                child = node.get(d)
+                if child is None:
+                    break
+                path.append((node, d))
+                node = child
+                v = node.get(None)
+                if v is not None:
+                    if v[1] > now:
+                        found = v[0]
+                    else:
+                        del node[None]
+
+            # Prune empty nodes: bottom-up, up to the first node still in use
+            for parent, d in reversed(path):
+                if parent[d]:
+                    break
+                del parent[d]
+        return found
+
+
+class RouteCoverageCache(object):
+    """ Cache of route coverage: tells whether a destination number can be routed, without a request
+
+        Fed by `routeCoverage` queries, and by failures of sent messages:
+
+        * 'E105 Invalid destination address' marks the number
+        * 'E114 Cannot route message' marks the number prefix
+
+        Cached values are error codes: 0 for routable prefixes, or the code sending is expected to fail with.
+    """
+
+    def __init__(self, api, ttl=86400, prefix_length=6):
+        """ Create the cache
+
+            :type api: ClickatellHttpApi
+            :param api: API client for `routeCoverage` queries
+            :type ttl: int
+            :param ttl: Time to keep the coverage info, seconds
+            :type prefix_length: int
+            :param prefix_length: Length of the prefix that a route applies to: country code + network code
+        """
+        self.api = api
+        self.ttl = ttl
+        self.prefix_length = prefix_length
+        self.trie = PrefixTrie()
+
+    def query(self, number):
+        """ Query route coverage for the number, and cache it
+
+            See :meth:`ClickatellHttpApi.api_request` for the list of raised exceptions.
+
+            :type number: str
+            :param number: Destination number, digits only
+            :rtype: bool
+            :returns: Whether the number is routable
+        """
+        try:
+            response = self.api.api_request('routeCoverage', msisdn=number)
+        except ClickatellApiError as e:
+            if not self.failed(number, e.code):
+                raise
+            return False
+
+        # "OK: This prefix is currently supported. ..." | "ERR: This prefix is not currently supported. ..."
+        routable = response.startswith('OK')
+        self.trie.set(number[:self.prefix_length], 0 if routable else error.E114.code, time.time() + self.ttl)
+        return routable
+
+    def failed(self, number, code):
+        """ Record a failure to send a message to the number
+
+            :type number: str
+            :param number: Destination number, digits only
+            :type code: int
+            :param code: Error code
+            :rtype: bool
+            :returns: Whether the error was about coverage
+        """
+        if code == error.E105.code:
+            self.trie.set(number, code, time.time() + self.ttl)
+        elif code == error.E114.code:
+            self.trie.set(number[:self.prefix_length], code, time.time() + self.ttl)
+        else:
+            return False
+        return True
+
+    def lookup(self, number):
+        """ Look up the number
+
+            :type number: str
+            :param number: Destination number, digits only
+            :rtype: int|None
+            :returns: 0: routable, error code: unroutable, None: unknown
+        """
+        return self.trie.lookup(number)
+
+    def classify(self, numbers):
+        """ Look up many numbers in a single pass
+
+            :type numbers: iterable
+            :param numbers: Destination numbers, digits only
+            :rtype: generator
+            :returns: (number, 0|error code|None) tuples, see :meth:`lookup`
+        """
+        now = time.time()
+        lookup = self.trie.lookup
+        for number in numbers:
+            yield number, lookup(number, now)
@@ -0,0 +1,153 @@
+""" Client message ids and the index of submitted messages """
+
+import os
+import binascii
+import threading
+from itertools import count
+from collections import OrderedDict
+
+from .api import ClickatellApiError
+
+
+class ClientMessageIds(object):
+    """ Generator of compact unique client message ids (`cliMsgId`)
+
+        An id is a random prefix followed by a base-36 counter: 8-16 chars, well under the 32-char limit.
+        The prefix is regenerated in forked processes, so ids stay unique across workers.
+    """
+
+    _digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+    def __init__(self):
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def next(self):
+        """ Generate a new client message id
+
+            :rtype: str
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._prefix = binascii.hexlify(os.urandom(4))
+                self._counter = count()
+            prefix, n = self._prefix, next(self._counter)
+
+        s = ''
+        while True:
+            n, d = divmod(n, 36)
+            s = self._digits[d] + s
+            if not n:
+                break
+        return prefix + s
+
+
+class _Submission(object):
+    """ A message submission tracked by :class:`InFlightIndex` """
+
+    def __init__(self):
+        #: Set when the submission has completed
+        self.done = threading.Event()
+        #: Message id, when known
+        self.msgid = None
+        #: The error the submission has failed with
+        self.error = None
+        #: Is the outcome unknown? (e.g. the request has timed out)
+        self.uncertain = False
+
+
+class InFlightIndex(object):
+    """ Index of submitted messages by client message id
+
+        * Concurrent submits of the same message are coalesced into a single request
+        * Submits of an already sent message return its msgid without any requests
+        * Submits of a message with an unknown outcome (e.g. a timeout) query Clickatell before sending it again
+        * Definite failures (errors reported by Clickatell) are forgotten, so the message can be sent again
+    """
+
+    def __init__(self, size=10000):
+        """ Create the index
+
+            :type size: int
+            :param size: Maximum number of remembered submissions. The oldest are evicted.
+        """
+        self.size = size
+        self._lock = threading.Lock()
+        self._submissions = OrderedDict()
+
+    def __len__(self):
+        return len(self._submissions)
+
+    def submit(self, climsgid, send, query):
+        """ Submit a message at most once
+
+            :param climsgid: Client message id
+            :type send: callable
+            :param send: send() -> msgid: send the message
+            :type query: callable
+            :param query: query() -> msgid|None: find an already sent message by its client message id
+            :rtype: str
+            :returns: Message id
+        """
+        # Find or register the submission
+        with self._lock:
+            sub = self._submissions.get(climsgid)
+            owner = sub is None or (sub.done.is_set() and sub.msgid is None)
+            if owner:
+                uncertain = sub is not None and sub.uncertain
+                sub = self._submissions[climsgid] = _Submission()
+                while len(self._submissions) > self.size:
+                    self._submissions.popitem(last=False)
+
+        # Somebody else is sending it: wait for the outcome
+        if not owner:
+            sub.done.wait()
+            if sub.msgid is None:
+                raise sub.error
+            return sub.msgid
+
+        # Send it
+        sending = False
+        try:
+            # Unknown outcome of the previous attempt: find out whether the message went out
+            msgid = uncertain and query()
+            if not msgid:
+                sending = True
+                msgid = send()
+        except Exception as e:
+            # Rejected: it's safe to send again
+            if sending and isinstance(e, ClickatellApiError):
+                sub.error = e
+                with self._lock:
+                    if self._submissions.get(climsgid) is sub:
+                        del self._submissions[climsgid]
+                raise
+
+            # Unknown outcome (the request or the query has failed), unless a status report has already resolved it
+            if sub.msgid is None:
+                sub.error = e
+                sub.uncertain = True
+                raise
+        else:
+            sub.msgid = msgid
+        finally:
+            sub.done.set()
+        return sub.msgid
+
+    def resolve(self, climsgid, msgid):
+        """ Learn the msgid of a submission, e.g. from a status report
+
+            :param climsgid: Client message id
+            :param msgid: Message id
+            :rtype: bool
+            :returns: Whether the submission was known and is now resolved
+        """
+        with self._lock:
+            sub = self._submissions.get(climsgid)
+            if sub is None:
+                return False
+            if sub.msgid is None:
+                sub.msgid = msgid
+                sub.uncertain = False
+            return True
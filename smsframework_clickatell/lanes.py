@@ -0,0 +1,260 @@
+""" Priority lanes for outgoing messages """
+
+import time
+import threading
+from collections import deque
+
+from .ratelimit import TokenBucket
+from .latency import RollingHistogram
+
+
+class Lane(object):
+    """ A lane of :class:`LaneScheduler`: a queue with its own priority, weight, concurrency and rate """
+
+    #: Wait time histogram bounds, seconds: 1ms .. ~12h, +25% each
+    wait_bounds = tuple(0.001 * 1.25 ** i for i in range(75))
+
+    def __init__(self, name, priority=0, weight=1, concurrency=None, rate=None):
+        """ Create a lane
+
+            :type name: str
+            :param name: Lane name
+            :type priority: int
+            :param priority: Priority: lanes with a lower value are always served first
+            :type weight: int
+            :param weight: Share among the lanes of the same priority
+            :type concurrency: int|None
+            :param concurrency: The maximum number of messages of this lane being sent at the same time. None: no limit
+            :type rate: float|None
+            :param rate: The maximum number of messages per second. None: no limit
+        """
+        self.name = name
+        self.priority = priority
+        self.weight = weight
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate) if rate else None
+
+        #: Queued jobs
+        self.queue = deque()
+        #: The number of jobs being sent
+        self.inflight = 0
+        #: The number of jobs sent, and failed
+        self.sent = 0
+        self.failed = 0
+        #: Time spent in the queue, seconds
+        self.wait_time = RollingHistogram(window=300, slices=10, bounds=self.wait_bounds)
+
+        self._credit = 0  # smooth weighted round-robin
+
+    @property
+    def ready(self):
+        """ Can a job be taken from the lane? Does not check the rate.
+
+            :rtype: bool
+        """
+        return bool(self.queue) and (self.concurrency is None or self.inflight < self.concurrency)
+
+
+class Job(object):
+    """ A message queued in :class:`LaneScheduler` """
+
+    def __init__(self, message, lane):
+        self.message = message
+        self.lane = lane
+        self.queued = time.time()
+        self.error = None
+        self._done = threading.Event()
+
+    @property
+    def done(self):
+        """ Has the message been sent (or has it failed)?
+
+            :rtype: bool
+        """
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """ Wait for the message to be sent
+
+            :type timeout: float|None
+            :param timeout: Timeout, seconds
+            :rtype: smsframework.data.OutgoingMessage
+            :returns: The sent message
+            :raises ProviderError: Sending failed, see :meth:`ClickatellProvider.send`
+            :raises RuntimeError: Timed out
+        """
+        if not self._done.wait(timeout):
+            raise RuntimeError('Timed out waiting for the message to be sent')
+        if self.error is not None:
+            raise self.error
+        return self.message
+
+
+class LaneScheduler(object):
+    """ Multi-lane scheduler in front of :meth:`ClickatellProvider.send`
+
+        Messages are queued into lanes, and a pool of worker threads sends them:
+
+        * Lanes of a higher priority (lower value) are always served first
+        * Lanes of the same priority share the workers according to their weights
+        * Every lane may be limited in concurrency and rate
+
+        By default, high-priority messages (`escalate` option) go to the 'high' lane, others - to the default lane.
+        Without a 'high' lane, all messages go to the default lane.
+
+        Priorities only order the queues: a worker busy with a bulk message is not preempted. With the default lanes,
+        the 'normal' lane may use all workers but one, so a high-priority message always finds a free worker.
+        Custom lanes should reserve workers the same way, with `concurrency`.
+
+        With :class:`AdaptiveConcurrencyLimiter` enabled, requests also wait for a limiter slot, first come first served,
+        whatever the lane. Keep the total concurrency of the bulk lanes below the limiter's `min_limit` to keep
+        a slot free for high-priority messages.
+    """
+
+    #: Default lanes: { name: Lane options }. The 'normal' lane leaves a worker free, see :meth:`__init__`
+    default_lanes = {
+        'high': dict(priority=0),
+        'normal': dict(priority=1),
+    }
+
+    def __init__(self, provider, lanes=None, workers=8, default='normal'):
+        """ Create the scheduler and start the workers
+
+            :type provider: ClickatellProvider
+            :param provider: The provider to send messages with
+            :type lanes: dict|None
+            :param lanes: Lanes: { name: :class:`Lane` options }. Default: :attr:`default_lanes`,
+                with the 'normal' lane limited to `workers - 1`
+            :type workers: int
+            :param workers: The number of worker threads
+            :type default: str
+            :param default: The lane for messages that are not high-priority
+        """
+        self.provider = provider
+        if lanes is None:
+            # Reserve a worker for high-priority messages
+            lanes = dict(self.default_lanes, normal=dict(self.default_lanes['normal'], concurrency=max(1, workers - 1)))
+        self.lanes = dict((name, Lane(name, **options)) for name, options in lanes.items())
+        self.default = default
+        assert default in self.lanes, 'Unknown default lane: {}'.format(default)
+        self._priorities = sorted(set(lane.priority for lane in self.lanes.values()))
+
+        self._cond = threading.Condition()
+        self._closed = False
+        self._workers = [threading.Thread(target=self._work) for i in range(workers)]
+        for w in self._workers:
+            w.daemon = True
+            w.start()
+
+    def lane_for(self, message):
+        """ Pick a lane for the message: override to customize
+
+            :type message: smsframework.data.OutgoingMessage
+            :rtype: str
+        """
+        return 'high' if message.provider_options.escalate and 'high' in self.lanes else self.default
+
+    def submit(self, message, lane=None):
+        """ Queue a message for sending
+
+            :type message: smsframework.data.OutgoingMessage
+            :param message: The message to send
+            :type lane: str|None
+            :param lane: Lane name. Default: picked by :meth:`lane_for`
+            :rtype: Job
+        """
+        lane = lane or self.lane_for(message)
+        assert lane in self.lanes, 'Unknown lane: {}'.format(lane)
+        job = Job(message, self.lanes[lane])
+        with self._cond:
+            assert not self._closed, 'The scheduler is closed'
+            job.lane.queue.append(job)
+            self._cond.notify()
+        return job
+
+    def _next(self):
+        """ Wait for the next job to send
+
+            :rtype: Job|None
+            :returns: The job, or None when the scheduler is closed and there is nothing left to send
+        """
+        with self._cond:
+            while True:
+                # Strict priorities: the first priority with a ready lane wins
+                for priority in self._priorities:
+                    ready = [lane for lane in self.lanes.values() if lane.priority == priority and lane.ready]
+                    while ready:
+                        # Same priority: smooth weighted round-robin
+                        for lane in ready:
+                            lane._credit += lane.weight
+                        lane = max(ready, key=lambda l: l._credit)
+                        lane._credit -= sum(l.weight for l in ready)
+
+                        # Rate limit
+                        if lane.bucket is not None and not lane.bucket.acquire(block=False):
+                            ready.remove(lane)
+                            continue
+
+                        job = lane.queue.popleft()
+                        lane.inflight += 1
+                        lane.wait_time.record(time.time() - job.queued)
+                        return job
+
+                # Nothing ready
+                if self._closed and not any(lane.queue for lane in self.lanes.values()):
+                    return None
+                self._cond.wait(0.05 if any(lane.queue for lane in self.lanes.values()) else None)
+
+    def _work(self):
+        """ Worker thread: send jobs """
+        while True:
+            job = self._next()
+            if job is None:
+                return
+
+            try:
+                self.provider.send(job.message)
+            except Exception as e:
+                job.error = e
+
+            with self._cond:
+                job.lane.inflight -= 1
+                if job.error is None:
+                    job.lane.sent += 1
+                else:
+                    job.lane.failed += 1
+                self._cond.notify_all()
+            job._done.set()
+
+    def close(self, wait=True):
+        """ Stop accepting messages, stop the workers when the queues are empty
+
+            :type wait: bool
+            :param wait: Wait for the queued messages to be sent
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if wait:
+            for w in self._workers:
+                w.join()
+
+    def metrics(self, percentiles=(50, 90, 99)):
+        """ Get per-lane metrics
+
+            :type percentiles: iterable
+            :param percentiles: Wait time percentiles to report
+            :rtype: dict
+            :returns: { lane: {'queued': int, 'inflight': int, 'sent': int, 'failed': int, 'wait': {'p50': float, ...}} }
+        """
+        with self._cond:
+            return dict(
+                (name, {
+                    'queued': len(lane.queue),
+                    'inflight': lane.inflight,
+                    'sent': lane.sent,
+                    'failed': lane.failed,
+                    'wait': dict(('p{}'.format(p), v) for p, v in zip(percentiles, lane.wait_time.percentiles(percentiles))),
+                })
+                for name, lane in self.lanes.items()
+            )
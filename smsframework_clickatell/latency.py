@@ -0,0 +1,201 @@
+""" End-to-end delivery latency: from submit to status report """
+
+import time
+import bisect
+import threading
+from collections import OrderedDict
+
+
+class RollingHistogram(object):
+    """ Histogram of values over a rolling time window
+
+        Values are counted in logarithmic buckets. The window is split into slices that expire one by one,
+        so memory is fixed no matter how many values are recorded.
+    """
+
+    #: Default bucket upper bounds, seconds: 0.1s .. ~2 days, +25% each
+    default_bounds = tuple(0.1 * 1.25 ** i for i in range(65))
+
+    def __init__(self, window=3600, slices=12, bounds=default_bounds):
+        """ Create the histogram
+
+            :type window: int
+            :param window: Window length, seconds
+            :type slices: int
+            :param slices: Number of slices the window is split into
+            :type bounds: tuple
+            :param bounds: Bucket upper bounds, ascending. Larger values go to an overflow bucket.
+        """
+        self.bounds = bounds
+        self._slice = float(window) / slices
+        self._ids = [None] * slices
+        self._counts = [[0] * (len(bounds) + 1) for i in range(slices)]
+
+    def record(self, value, now=None):
+        """ Record a value
+
+            :type value: float
+        """
+        i = int((time.time() if now is None else now) / self._slice)
+        k = i % len(self._ids)
+        if self._ids[k] != i:
+            self._ids[k] = i
+            self._counts[k] = [0] * (len(self.bounds) + 1)
+        self._counts[k][bisect.bisect_left(self.bounds, value)] += 1
+
+    def _merged(self, now=None):
+        """ Get the bucket counts of the live slices """
+        i = int((time.time() if now is None else now) / self._slice)
+        live = [c for id, c in zip(self._ids, self._counts) if id is not None and i - len(self._ids) < id <= i]
+        return [sum(b) for b in zip(*live)] if live else [0] * (len(self.bounds) + 1)
+
+    def count(self, now=None):
+        """ Get the number of values within the window
+
+            :rtype: int
+        """
+        return sum(self._merged(now))
+
+    def percentiles(self, ps, now=None):
+        """ Get percentiles of the values within the window
+
+            A percentile is reported as the upper bound of its bucket; values in the overflow bucket are reported as inf.
+
+            :type ps: iterable
+            :param ps: Percentiles: 0..100
+            :rtype: list
+            :returns: List of values, or None's when the window is empty
+        """
+        counts = self._merged(now)
+        total = sum(counts)
+        ret = []
+        for p in ps:
+            if not total:
+                ret.append(None)
+                continue
+            rank, cum = p / 100.0 * total, 0
+            for bucket, n in enumerate(counts):
+                cum += n
+                if n and cum >= rank:
+                    break
+            ret.append(self.bounds[bucket] if bucket < len(self.bounds) else float('inf'))
+        return ret
+
+
+class DeliveryLatencyTracker(object):
+    """ Delivery latency tracker
+
+        Remembers the submit time of every sent message, and joins it with the status reports:
+
+        * 'gateway': submit -> S003 Delivered to gateway
+        * 'recipient': submit -> S004 Received by recipient
+
+        Latencies are counted per sender id and per destination prefix.
+        Messages that never report are evicted after `ttl`, or when there are more than `size` pending messages.
+    """
+
+    #: Status codes of the tracked stages
+    stages = {3: 'gateway', 4: 'recipient'}
+
+    def __init__(self, prefix_length=3, ttl=172800, size=100000, window=3600):
+        """ Create the tracker
+
+            :type prefix_length: int
+            :param prefix_length: Length of the destination prefix to group by
+            :type ttl: int
+            :param ttl: How long to wait for status reports, seconds
+            :type size: int
+            :param size: Maximum number of pending messages
+            :type window: int
+            :param window: Histograms window, seconds
+        """
+        self.prefix_length = prefix_length
+        self.ttl = ttl
+        self.size = size
+        self.window = window
+
+        #: Number of pending messages evicted without a final report
+        self.evicted = 0
+
+        self._lock = threading.Lock()
+        self._pending = OrderedDict()  # msgid -> (submit time, sender, prefix)
+        self._histograms = {}  # (stage, 'sender'|'prefix', key) -> RollingHistogram
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _evict(self, now):
+        """ Evict pending messages that are too old, or too many """
+        while self._pending:
+            msgid, (submitted, sender, prefix) = next(self._pending.iteritems())
+            if len(self._pending) <= self.size and submitted > now - self.ttl:
+                break
+            del self._pending[msgid]
+            self.evicted += 1
+
+    def _histogram(self, stage, dimension, key):
+        h = self._histograms.get((stage, dimension, key))
+        if h is None:
+            h = self._histograms[(stage, dimension, key)] = RollingHistogram(self.window)
+        return h
+
+    def submitted(self, msgid, sender, dst, now=None):
+        """ Record a submitted message
+
+            A message that's already pending keeps its original submit time.
+
+            :param msgid: Message id
+            :param sender: Sender id, or '' for the default one
+            :param dst: Destination number, digits only
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            if msgid not in self._pending:
+                self._pending[msgid] = (now, sender or '', dst[:self.prefix_length])
+            self._evict(now)
+
+    def status(self, status, now=None):
+        """ Record a status report
+
+            :type status: smsframework.data.MessageStatus
+            :rtype: float|None
+            :returns: Latency, if the status is one of the tracked stages
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            pending = self._pending.get(status.msgid)
+            if pending is None:
+                return None
+
+            # Final status: forget the message
+            if status.delivered or status.error or status.expired:
+                del self._pending[status.msgid]
+
+            # Record
+            stage = self.stages.get(status.status_code)
+            if stage is None:
+                return None
+            submitted, sender, prefix = pending
+            latency = now - submitted
+            self._histogram(stage, 'sender', sender).record(latency, now)
+            self._histogram(stage, 'prefix', prefix).record(latency, now)
+            return latency
+
+    def export(self, percentiles=(50, 90, 99), now=None):
+        """ Export latency percentiles
+
+            :type percentiles: iterable
+            :param percentiles: Percentiles to report
+            :rtype: dict
+            :returns: { stage: { 'sender'|'prefix': { key: {'count': int, 'p50': float, ...} } } }
+        """
+        ret = {}
+        with self._lock:
+            for (stage, dimension, key), h in self._histograms.items():
+                count = h.count(now)
+                if not count:
+                    continue
+                stats = dict(('p{}'.format(p), v) for p, v in zip(percentiles, h.percentiles(percentiles, now)))
+                stats['count'] = count
+                ret.setdefault(stage, {}).setdefault(dimension, {})[key] = stats
+        return ret
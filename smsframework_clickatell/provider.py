@@ -1,22 +1,62 @@
+import time
+
 from smsframework import IProvider, exc
 from . import error
 from . import status
 from .api import ClickatellHttpApi, ClickatellApiError
+from .inflight import ClientMessageIds, InFlightIndex
+from .latency import DeliveryLatencyTracker
+from .concurrency import AdaptiveConcurrencyLimiter
+from .coverage import RouteCoverageCache
+from .blocklist import Blocklist
 from urllib2 import URLError, HTTPError
 
 
 class ClickatellProvider(IProvider):
     """ Clickatell provider """
 
-    def __init__(self, gateway, name, api_id, user, password, https=False):
+    def __init__(self, gateway, name, api_id=None, user=None, password=None, https=False, transport='http', token=None,
+                 concurrency=None, session=False):
         """ Configure Clickatell provider
 
             :param api_id: API ID to use
             :param user: Account username
             :param password: Account password
             :param https: Use HTTPS for outgoing messages?
+            :param transport: Transport to send messages with: 'http' (HTTP API), 'rest' (REST API), or a custom
+                :class:`ClickatellTransport` subclass
+            :param token: REST API auth token. Required for the 'rest' transport
+            :type concurrency: dict|None
+            :param concurrency: Adapt the number of concurrent requests to how Clickatell copes with them:
+                :class:`AdaptiveConcurrencyLimiter` options. None: no limit
+            :type session: bool
+            :param session: Authenticate once, and send the session id with requests instead of the credentials.
+                The session is kept alive, and renewed when it expires.
         """
-        self.api = ClickatellHttpApi(api_id, user, password, https)
+        self._api_config = dict(api_id=api_id, user=user, password=password, https=https, transport=transport, token=token,
+                                session=session)
+        self.api = ClickatellHttpApi(**self._api_config)
+        if concurrency is not None:
+            self.api.limiter = AdaptiveConcurrencyLimiter(**concurrency)
+
+        #: Client message ids generator
+        self.climsgids = ClientMessageIds()
+
+        #: Submitted messages, by client message id
+        self.inflight = InFlightIndex()
+
+        #: Delivery latency: submit -> status report
+        self.latency = DeliveryLatencyTracker()
+
+        #: Route coverage: unroutable destinations fail without a request
+        self.coverage = RouteCoverageCache(self.api)
+
+        #: Blocked destinations: messages to them fail without a request
+        self.blocklist = Blocklist()
+
+        # Last queried balance: (timestamp, balance)
+        self._balance = None
+
         super(ClickatellProvider, self).__init__(gateway, name)
 
     def send(self, message):
@@ -25,6 +65,16 @@ class ClickatellProvider(IProvider):
             :type message: smsframework.data.OutgoingMessage.OutgoingMessage
             :rtype: OutgoingMessage
             """
+        # Fail fast: blocked destination
+        code = self.blocklist.lookup(message.dst)
+        if code:
+            raise error.ClickatellProviderError(code, 'Blocklist')
+
+        # Fail fast: known unroutable destination
+        code = self.coverage.lookup(message.dst)
+        if code:
+            raise error.ClickatellProviderError(code, 'Route coverage cache')
+
         # Parameters
         params = {}
         if message.src:
@@ -41,17 +91,47 @@ class ClickatellProvider(IProvider):
             params['from'] = message.provider_options.senderId
         params.update(message.provider_params)
 
-        # Send
+        # Client message id: sending the same message again reuses it
+        if message.meta is None:
+            message.meta = {}
+        params.setdefault('climsgid', message.meta.get('cliMsgId') or self.climsgids.next())
+        message.meta['cliMsgId'] = params['climsgid']
+
+        # Send, at most once
         try:
-            message.msgid = self.api.sendmsg(message.dst, message.body, **params)
+            message.msgid = self.inflight.submit(
+                params['climsgid'],
+                lambda: self.api.sendmsg(message.dst, message.body, **params),
+                lambda: self._query_climsgid(params['climsgid'])
+            )
+            self.latency.submitted(message.msgid, params.get('from'), message.dst)
             return message
         except HTTPError as e:
             raise exc.MessageSendError(e.message)
         except URLError as e:
             raise exc.ConnectionError(e.message)
         except ClickatellApiError as e:
+            self.failed(message.dst, e.code)
             raise error.ClickatellProviderError(e.code, e.message)  # will mutate into the necessary error object
 
+    def _query_climsgid(self, climsgid):
+        """ Find a sent message by its client message id
+
+            :rtype: str|None
+            :returns: Message id, or None if the message was never sent
+        """
+        try:
+            return self.api.transport.querymsg(climsgid)
+        except NotImplementedError:
+            return None  # the transport can't tell: send it again
+
+    def _receive_status(self, status):
+        # Status reports resolve submissions with an unknown outcome
+        if status.meta.get('cliMsgId'):
+            self.inflight.resolve(status.meta['cliMsgId'], status.msgid)
+        self.latency.status(status)
+        return super(ClickatellProvider, self)._receive_status(status)
+
     def make_receiver_blueprint(self):
         """ Create the receiver blueprint
 
@@ -80,14 +160,86 @@ class ClickatellProvider(IProvider):
         except ClickatellApiError as e:
             raise error.ClickatellProviderError(e.code, e.message)  # will mutate into the necessary error object
 
-    def getbalance(self):
+    def failed(self, dst, code):
+        """ Learn from a message rejected by Clickatell: update :attr:`coverage` and :attr:`blocklist`
+
+            :type dst: str
+            :param dst: Destination number, digits only
+            :type code: int
+            :param code: Error code
+        """
+        self.coverage.failed(dst, code)
+        if code in self.blocklist.codes:
+            self.blocklist.add(dst, code)
+
+    def close(self):
+        """ Release the resources: stop the session keepalive, if running """
+        self.api.close()
+
+    def scheduler(self, lanes=None, workers=8, default='normal'):
+        """ Create a multi-lane scheduler: high-priority messages never queue behind bulk ones
+
+            :type lanes: dict|None
+            :param lanes: Lanes: { name: :class:`Lane` options }. Default: 'high' for escalated messages, and 'normal'
+            :type workers: int
+            :param workers: The number of worker threads
+            :type default: str
+            :param default: The lane for messages that are not escalated
+            :rtype: LaneScheduler
+        """
+        from .lanes import LaneScheduler
+        return LaneScheduler(self, lanes, workers, default)
+
+    def querymsg(self, apimsgid=None, climsgid=None):
+        """ Query message status
+
+            :param apimsgid: Message id
+            :param climsgid: Client message id: `message.meta['cliMsgId']`
+            :rtype: (str, int)
+            :returns: (message id, status code)
+        """
+        try:
+            return self.api.querymsg(apimsgid, climsgid)
+        except HTTPError as e:
+            raise exc.MessageSendError(e.message)
+        except URLError as e:
+            raise exc.ConnectionError(e.message)
+        except ClickatellApiError as e:
+            raise error.ClickatellProviderError(e.code, e.message)
+
+    def campaign(self, processes=4, rate=10, burst=None, blocklist=None):
+        """ Create a campaign executor: sends a message to many recipients with a pool of worker processes
+
+            Rejected recipients update :attr:`coverage` and :attr:`blocklist`, see :meth:`failed`.
+
+            :type processes: int
+            :param processes: The number of worker processes
+            :type rate: float
+            :param rate: Messages per second, for all workers together
+            :type burst: int
+            :param burst: Burst size. Default: one second worth of messages
+            :type blocklist: str|None
+            :param blocklist: Path to save :attr:`blocklist` to, for the workers to skip blocked destinations
+            :rtype: CampaignExecutor
+        """
+        from .campaign import CampaignExecutor
+        if blocklist is not None:
+            self.blocklist.save(blocklist)
+        return CampaignExecutor(self._api_config, processes, rate, burst, blocklist=blocklist, failed=self.failed)
+
+    def getbalance(self, max_age=None):
         """ Query balance
 
+            :type max_age: int|None
+            :param max_age: Use the balance queried within this many seconds, if any. None: always query
             :rtype: float
             :returns: The number of credits available
         """
+        if max_age is not None and self._balance is not None and self._balance[0] > time.time() - max_age:
+            return self._balance[1]
+
         try:
-            return self.api.getbalance()
+            balance = self.api.getbalance()
         except HTTPError as e:
             raise exc.MessageSendError(e.message)
         except URLError as e:
@@ -95,4 +247,24 @@ class ClickatellProvider(IProvider):
         except ClickatellApiError as e:
             raise error.ClickatellProviderError(e.code, e.message)
 
+        self._balance = (time.time(), balance)
+        return balance
+
+    def estimate_cost(self, messages, pricing, default=None, max_age=300):
+        """ Estimate the cost of sending messages, and compare it with the balance
+
+            :type messages: iterable
+            :param messages: (destination, text) pairs. Destinations: digits only
+            :type pricing: dict
+            :param pricing: Credits per message part, by destination prefix: { '380': 0.8, '1': 1.0, ... }
+            :type default: float|None
+            :param default: Credits per message part for destinations not in the table
+            :type max_age: int|None
+            :param max_age: Use the balance queried within this many seconds, if any. None: always query
+            :rtype: dict
+            :returns: See :meth:`CostEstimator.estimate`
+        """
+        from .cost import CostEstimator
+        return CostEstimator(pricing, default).estimate(messages, balance=self.getbalance(max_age))
+
     #endregion
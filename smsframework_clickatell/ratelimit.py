@@ -0,0 +1,62 @@
+""" Rate limiting """
+
+import time
+import multiprocessing
+
+
+class TokenBucket(object):
+    """ Token bucket rate limiter, shared between threads and processes
+
+        The state lives in shared memory: create the bucket before starting the worker processes.
+
+        Besides the rate, the bucket holds a backoff deadline: when Clickatell reports the MT limit exceeded (E130),
+        one worker sets the deadline, and everybody waits.
+    """
+
+    def __init__(self, rate, burst=None):
+        """ Create the bucket
+
+            :type rate: float
+            :param rate: Tokens per second
+            :type burst: int
+            :param burst: Bucket capacity. Default: one second worth of tokens
+        """
+        self.rate = float(rate)
+        self.burst = max(1, int(burst or rate))
+        self._lock = multiprocessing.Lock()
+        self._state = multiprocessing.RawArray('d', [self.burst, time.time(), 0.0])  # tokens, updated at, backoff until
+
+    def backoff(self, until):
+        """ Stop handing out tokens until the given time
+
+            :type until: float
+            :param until: Unix timestamp
+        """
+        with self._lock:
+            self._state[2] = max(self._state[2], until)
+
+    def acquire(self, n=1, block=True):
+        """ Take tokens from the bucket
+
+            :type n: int
+            :param n: The number of tokens. No more than `burst`
+            :type block: bool
+            :param block: Wait for the tokens?
+            :rtype: bool
+            :returns: Whether the tokens were taken
+        """
+        assert n <= self.burst, 'Cannot acquire more tokens than the bucket holds'
+        while True:
+            with self._lock:
+                now = time.time()
+                tokens, updated, backoff = self._state
+                tokens = min(self.burst, tokens + (now - updated) * self.rate)
+                self._state[1] = now
+                if now >= backoff and tokens >= n:
+                    self._state[0] = tokens - n
+                    return True
+                self._state[0] = tokens
+                wait = max(backoff - now, (n - tokens) / self.rate)
+            if not block:
+                return False
+            time.sleep(wait)
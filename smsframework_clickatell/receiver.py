@@ -89,14 +89,17 @@ def status():
         assert n in req, 'Clickatell sent a status with missing "{}" field: {}'.format(n, req)
 
     # MessageStatus
+    meta = {
+        'status': int(req['status']),
+        'api_id': req['api_id'],
+        'charge': float(req['charge'])
+    }
+    if req.get('cliMsgId'):
+        meta['cliMsgId'] = req['cliMsgId']
     status = ClickatellMessageStatus.from_code(
         int(req['status']),
         msgid=req['moMsgId'],
-        meta={
-            'status': int(req['status']),
-            'api_id': req['api_id'],
-            'charge': float(req['charge'])
-        }
+        meta=meta
     )
 
     # Process it
@@ -1,15 +1,29 @@
 # -*- coding: utf-8 -*-
 
+import os
+import time
+import socket
+import tempfile
 import unittest
+import threading
+import multiprocessing
 from datetime import datetime
+from urllib2 import URLError
+from StringIO import StringIO
 
 from flask import Flask
 
-from smsframework import Gateway, OutgoingMessage
+from smsframework import Gateway, OutgoingMessage, exc
 from smsframework.providers import NullProvider
 from smsframework_clickatell import ClickatellProvider
 
-from smsframework_clickatell import error, status
+from smsframework_clickatell import error, status, cost
+from smsframework_clickatell.api import ClickatellHttpApi, ClickatellApiError, ClickatellTransport, message_parts
+from smsframework_clickatell.inflight import ClientMessageIds
+from smsframework_clickatell.latency import DeliveryLatencyTracker
+from smsframework_clickatell.ratelimit import TokenBucket
+from smsframework_clickatell.blocklist import Blocklist, MappedBlocklist
+from smsframework_clickatell.cost import CostEstimator
 
 
 class ClickatellProviderTest(unittest.TestCase):
@@ -80,6 +94,679 @@ class ClickatellProviderTest(unittest.TestCase):
         self._mock_response('ERR: 001, Auth fail')
         self.assertRaises(error.E001, gw.send, OutgoingMessage('+123456', 'hey', provider='main'))
 
+    def test_send_climsgid(self):
+        """ Test client message ids: retries do not duplicate messages """
+        gw = self.gw
+        provider = gw.get_provider('main')
+
+        requests = []
+        def _mock(*responses):
+            responses = list(responses)
+            def _api_request(method, **params):
+                requests.append((method, params.get('climsgid')))
+                response = responses.pop(0)
+                if isinstance(response, Exception):
+                    raise response
+                return response
+            provider.api._api_request = _api_request
+
+        # Sent once, retry costs nothing
+        _mock('ID: 1')
+        message = OutgoingMessage('+123456', 'hey', provider='main')
+        gw.send(message)
+        climsgid = message.meta['cliMsgId']
+        self.assertLessEqual(len(climsgid), 32)
+        self.assertEqual(requests, [('sendmsg', climsgid)])
+        gw.send(message)
+        self.assertEqual(message.msgid, '1')
+        self.assertEqual(len(requests), 1)
+
+        # Unique ids
+        self.assertEqual(len(set(provider.climsgids.next() for i in range(1000))), 1000)
+
+        # Timeout, then a retry: the message went out
+        del requests[:]
+        _mock(URLError('timeout'), 'ID: 2 Status: 003')
+        message = OutgoingMessage('+123456', 'hey', provider='main')
+        self.assertRaises(exc.ConnectionError, gw.send, message)
+        gw.send(message)
+        self.assertEqual(message.msgid, '2')
+        self.assertEqual([m for m, c in requests], ['sendmsg', 'querymsg'])
+
+        # Timeout, then a retry: the message did not go out
+        del requests[:]
+        _mock(URLError('timeout'), 'ERR: 104, Unknown client message ID', 'ID: 3')
+        message = OutgoingMessage('+123456', 'hey', provider='main')
+        self.assertRaises(exc.ConnectionError, gw.send, message)
+        gw.send(message)
+        self.assertEqual(message.msgid, '3')
+        self.assertEqual([m for m, c in requests], ['sendmsg', 'querymsg', 'sendmsg'])
+        self.assertEqual(len(set(c for m, c in requests)), 1)
+
+        # Timeout, then the query fails: still unknown, not sent again
+        del requests[:]
+        _mock(URLError('timeout'), 'ERR: 130, Maximum MT limit exceeded', 'ID: 6 Status: 003')
+        message = OutgoingMessage('+123456', 'hey', provider='main')
+        self.assertRaises(exc.ConnectionError, gw.send, message)
+        self.assertRaises(error.E130, gw.send, message)
+        gw.send(message)
+        self.assertEqual(message.msgid, '6')
+        self.assertEqual([m for m, c in requests], ['sendmsg', 'querymsg', 'querymsg'])
+
+        # Unique ids from concurrent first calls
+        climsgids = ClientMessageIds()
+        ids = []
+        threads = [threading.Thread(target=lambda: ids.extend(climsgids.next() for i in range(100))) for i in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(set(ids)), 1000)
+
+        # Timeout, then a status report
+        del requests[:]
+        _mock(URLError('timeout'))
+        message = OutgoingMessage('+123456', 'hey', provider='main')
+        self.assertRaises(exc.ConnectionError, gw.send, message)
+        with self.app.test_client() as c:
+            res = c.get('/a/b/main/status?from=123&to=456&status=3&api_id=100&moMsgId=4&charge=1&cliMsgId=' + message.meta['cliMsgId'])
+            self.assertEqual(res.status_code, 200)
+        gw.send(message)
+        self.assertEqual(message.msgid, '4')
+        self.assertEqual(len(requests), 1)
+
+        # Rejected: sent again
+        del requests[:]
+        _mock('ERR: 301, No credit left', 'ID: 5')
+        message = OutgoingMessage('+123456', 'hey', provider='main')
+        self.assertRaises(error.E301, gw.send, message)
+        gw.send(message)
+        self.assertEqual(message.msgid, '5')
+        self.assertEqual(len(requests), 2)
+
+    def test_latency(self):
+        """ Test delivery latency tracking """
+        gw = self.gw
+        latency = gw.get_provider('main').latency
+
+        # Send, get status reports
+        self._mock_response('ID: 1')
+        gw.send(OutgoingMessage('+380501234567', 'hey', provider='main').options(senderId='Me'))
+        self.assertEqual(len(latency), 1)
+        with self.app.test_client() as c:
+            for code in (2, 3, 4):
+                c.get('/a/b/main/status?from=123&to=456&api_id=100&moMsgId=1&charge=1&status={}'.format(code))
+        self.assertEqual(len(latency), 0)
+
+        stats = latency.export()
+        self.assertEqual(sorted(stats.keys()), ['gateway', 'recipient'])
+        self.assertEqual(stats['recipient']['sender'].keys(), ['Me'])
+        self.assertEqual(stats['recipient']['prefix'].keys(), ['380'])
+        self.assertEqual(stats['recipient']['prefix']['380']['count'], 1)
+        self.assertLess(stats['recipient']['prefix']['380']['p99'], 1)
+
+        # Percentiles, window
+        tracker = DeliveryLatencyTracker(window=60)
+        for i in range(100):
+            tracker.submitted(str(i), '', '123', now=1000)
+            tracker.status(status.S004(str(i)), now=1001 + i)
+        stats = tracker.export(percentiles=(50, 99), now=1100)['recipient']['prefix']['123']
+        self.assertEqual(stats['count'], 56)  # only the last minute is counted: latencies 45..100
+        self.assertTrue(73 <= stats['p50'] <= 73 * 1.25, stats)
+        self.assertTrue(100 <= stats['p99'] <= 100 * 1.25, stats)
+        self.assertEqual(tracker.export(now=10000), {})
+
+        # Eviction
+        tracker = DeliveryLatencyTracker(ttl=10, size=3)
+        for i in range(5):
+            tracker.submitted(str(i), '', '123', now=1000)
+        self.assertEqual(len(tracker), 3)
+        tracker.submitted('5', '', '123', now=1020)
+        self.assertEqual(len(tracker), 1)
+        self.assertEqual(tracker.evicted, 5)
+
+    def test_sendmsg_multi(self):
+        """ Test sending to multiple recipients """
+        api = self.gw.get_provider('main').api
+
+        # Batches
+        requests = []
+        def _api_request(method, **params):
+            to = params['to'].split(',')
+            requests.append(to)
+            return '\n'.join(
+                'ERR: 114, Cannot route message To: {}'.format(n) if n == '5' else 'ID: id{} To: {}'.format(n, n)
+                for n in to)
+        api._api_request = _api_request
+        api.transport.max_recipients = 2
+
+        results = api.sendmsg_multi(('1', '2', '3', '4', '5'), 'hey')
+        self.assertEqual(requests, [['1', '2'], ['3', '4'], ['5']])
+        self.assertEqual([(to, msgid) for to, msgid, e in results], [('1', 'id1'), ('2', 'id2'), ('3', 'id3'), ('4', 'id4'), ('5', None)])
+        self.assertEqual(results[4][2].code, 114)
+
+        # A single recipient in the last batch: its error is reported, not raised
+        def _api_request(method, **params):
+            to = params['to'].split(',')
+            if len(to) == 1:
+                return 'ERR: 105, Invalid destination address'
+            return '\n'.join('ID: id{} To: {}'.format(n, n) for n in to)
+        api._api_request = _api_request
+        results = api.sendmsg_multi(('1', '2', '3', '4', '5'), 'hey')
+        self.assertEqual([(to, msgid) for to, msgid, e in results], [('1', 'id1'), ('2', 'id2'), ('3', 'id3'), ('4', 'id4'), ('5', None)])
+        self.assertEqual(results[4][2].code, 105)
+
+        # A single recipient in the last batch, an error of the request: raised, as for any batch
+        def _api_request(method, **params):
+            to = params['to'].split(',')
+            if len(to) == 1:
+                return 'ERR: 130, Maximum MT limit exceeded'
+            return '\n'.join('ID: id{} To: {}'.format(n, n) for n in to)
+        api._api_request = _api_request
+        try:
+            api.sendmsg_multi(('1', '2', '3', '4', '5'), 'hey')
+            self.fail('Not raised')
+        except ClickatellApiError as e:
+            self.assertEqual(e.code, 130)
+            self.assertEqual([to for to, msgid, _ in e.results], ['1', '2', '3', '4'])
+
+        # Error of the whole request: the results of the batches already sent are kept
+        def _api_request(method, **params):
+            if params['to'] == '3,4':
+                return 'ERR: 001, Auth fail'
+            if params['to'] == '5':
+                raise URLError('timeout')
+            return '\n'.join('ID: id{} To: {}'.format(n, n) for n in params['to'].split(','))
+        api._api_request = _api_request
+        try:
+            api.sendmsg_multi(('1', '2', '3', '4', '5'), 'hey')
+            self.fail('Not raised')
+        except ClickatellApiError as e:
+            self.assertEqual(e.code, 1)
+            self.assertEqual(e.results, [('1', 'id1', None), ('2', 'id2', None)])
+        try:
+            api.sendmsg_multi(('1', '2', '5'), 'hey')
+            self.fail('Not raised')
+        except URLError as e:
+            self.assertEqual(e.results, [('1', 'id1', None), ('2', 'id2', None)])
+
+    def test_rest_transport(self):
+        """ Test the REST transport """
+        self.gw.add_provider('rest', ClickatellProvider, token='abc', transport='rest')
+        provider = self.gw.get_provider('rest')
+
+        requests = []
+        def _mock_rest(response):
+            def _rest_request(verb, path, data=None):
+                requests.append((verb, path, data))
+                return response
+            provider.api.transport._rest_request = _rest_request
+
+        # Balance
+        _mock_rest({'data': {'balance': '12.5'}})
+        self.assertEqual(provider.getbalance(), 12.5)
+        self.assertEqual(requests.pop(), ('GET', 'account/balance', None))
+
+        # Send
+        _mock_rest({'data': {'message': [{'accepted': True, 'to': '123456', 'apiMessageId': 'abc'}]}})
+        message = self.gw.send(OutgoingMessage('+123456', u'hey', provider='rest').options(expires=5))
+        self.assertEqual(message.msgid, 'abc')
+        self.assertEqual(requests.pop(), ('POST', 'message', {'to': ['123456'], 'text': u'hey', 'validityPeriod': 5, 'mo': 1,
+                                                              'clientMessageId': message.meta['cliMsgId']}))
+
+        # Parameters: renamed, or rejected
+        message = self.gw.send(OutgoingMessage('+123456', u'hey', provider='rest').options(status_report=True).params(deliv_time=10))
+        self.assertEqual(requests.pop()[2], {'to': ['123456'], 'text': u'hey', 'callback': 3, 'deliveryTime': 10, 'mo': 1,
+                                             'clientMessageId': message.meta['cliMsgId']})
+        self.assertRaises(ValueError, self.gw.send, OutgoingMessage('+123456', u'hey', provider='rest').params(binary=1))
+
+        # Recipient error
+        _mock_rest({'data': {'message': [{'accepted': False, 'to': '123456', 'error': {'code': '105', 'description': 'Invalid destination address'}}]}})
+        self.assertRaises(error.E105, self.gw.send, OutgoingMessage('+123456', 'hey', provider='rest'))
+
+        # Request error
+        _mock_rest({'error': {'code': '001', 'description': 'Authentication failed'}})
+        self.assertRaises(error.E001, self.gw.send, OutgoingMessage('+654321', 'hey', provider='rest'))
+
+        # Timeout, then a retry: found by the client message id, or sent again
+        def _mock_rest(*responses):
+            responses = list(responses)
+            def _rest_request(verb, path, data=None):
+                requests.append((verb, path, data))
+                response = responses.pop(0)
+                if isinstance(response, Exception):
+                    raise response
+                return response
+            provider.api.transport._rest_request = _rest_request
+        sent = {'data': {'message': [{'accepted': True, 'to': '123457', 'apiMessageId': 'def'}]}}
+
+        del requests[:]
+        _mock_rest(URLError('timeout'), {'data': {'apiMessageId': 'abc', 'messageStatus': '003'}})
+        message = OutgoingMessage('+123457', 'hey', provider='rest')
+        self.assertRaises(exc.ConnectionError, self.gw.send, message)
+        self.gw.send(message)
+        self.assertEqual(message.msgid, 'abc')
+        self.assertEqual([(verb, path) for verb, path, data in requests],
+                         [('POST', 'message'), ('GET', 'message/' + message.meta['cliMsgId'])])
+
+        del requests[:]
+        _mock_rest(URLError('timeout'), {'error': {'code': '104', 'description': 'Unknown client message ID'}}, sent)
+        message = OutgoingMessage('+123457', 'hey', provider='rest')
+        self.assertRaises(exc.ConnectionError, self.gw.send, message)
+        self.gw.send(message)
+        self.assertEqual(message.msgid, 'def')
+        self.assertEqual([verb for verb, path, data in requests], ['POST', 'GET', 'POST'])
+
+        # A transport that can't find messages: sent again
+        del requests[:]
+        _mock_rest(URLError('timeout'), sent)
+        provider.api.transport.querymsg = lambda climsgid: ClickatellTransport.querymsg(provider.api.transport, climsgid)
+        message = OutgoingMessage('+123457', 'hey', provider='rest')
+        self.assertRaises(exc.ConnectionError, self.gw.send, message)
+        self.gw.send(message)
+        self.assertEqual(message.msgid, 'def')
+        self.assertEqual([verb for verb, path, data in requests], ['POST', 'POST'])
+
+    def test_campaign(self):
+        """ Test the multi-process campaign executor """
+        provider = self.gw.get_provider('main')
+
+        # Mock the API in worker processes: the first request fails with E130
+        limited = multiprocessing.Value('i', 1)
+        def _api_request(self, method, **params):
+            with limited.get_lock():
+                if limited.value:
+                    limited.value = 0
+                    return 'ERR: 130, Maximum MT limit exceeded until {}'.format(int(time.time() + 0.2))
+            return '\n'.join(
+                'ERR: 105, Invalid destination address To: {}'.format(n) if n.endswith('3') else
+                'ERR: 122, Destination mobile opted out To: {}'.format(n) if n == '22' else
+                'ID: id{} To: {}'.format(n, n)
+                for n in params['to'].split(','))
+        _api_request_orig = ClickatellHttpApi._api_request
+        ClickatellHttpApi._api_request = _api_request
+        provider.blocklist.add('100', error.E121.code)
+        path = tempfile.mktemp()
+        try:
+            campaign = provider.campaign(processes=3, rate=100, burst=20, blocklist=path)
+            start = time.time()
+            results = list(campaign.run((str(n) for n in range(101)), 'hey'))
+            duration = time.time() - start
+        finally:
+            ClickatellHttpApi._api_request = _api_request_orig
+            os.unlink(path)
+
+        self.assertEqual(sorted(to for to, msgid, e in results), sorted(str(n) for n in range(101)))
+        for to, msgid, e in results:
+            if to == '100':
+                self.assertIsInstance(e, error.E121)
+            elif to.endswith('3'):
+                self.assertIsInstance(e, error.E105)
+            elif to == '22':
+                self.assertIsInstance(e, error.E122)
+            else:
+                self.assertEqual((msgid, e), ('id' + to, None))
+        self.assertGreater(duration, 0.8)  # 100 messages, 20 tokens ahead, 100/s
+
+        # Rejected recipients are remembered
+        self.assertEqual(provider.blocklist.lookup('22'), error.E122.code)
+        self.assertEqual(provider.coverage.lookup('13'), error.E105.code)
+        self.assertIsNone(provider.coverage.lookup('12'))
+
+        # Failed workers: the campaign stops
+        campaign = provider.campaign(processes=2, blocklist=None)
+        campaign.blocklist = '/nonexistent/blocklist.bin'
+        campaign.poll = 0.1
+        self.assertRaises(exc.ProviderError, list, campaign.run(['1', '2'], 'hey'))
+
+        # Killed workers: the campaign stops
+        ClickatellHttpApi._api_request = lambda self, method, **params: os._exit(1)
+        try:
+            campaign = provider.campaign(processes=2)
+            campaign.poll = 0.1
+            self.assertRaises(exc.ProviderError, list, campaign.run(['1', '2'], 'hey'))
+        finally:
+            ClickatellHttpApi._api_request = _api_request_orig
+
+    def test_token_bucket(self):
+        """ Test the token bucket """
+        bucket = TokenBucket(rate=100, burst=10)
+        start = time.time()
+        for i in range(30):
+            bucket.acquire()
+        self.assertTrue(0.15 < time.time() - start < 0.5)
+        self.assertFalse(bucket.acquire(5, block=False))
+
+        bucket.backoff(time.time() + 0.3)
+        time.sleep(0.1)
+        self.assertFalse(bucket.acquire(block=False))
+        bucket.acquire()
+        self.assertGreater(time.time() - start, 0.5)
+
+    def test_concurrency(self):
+        """ Test adaptive concurrency control """
+        self.gw.add_provider('limited', ClickatellProvider, api_id=10, user='kolypto', password='1234',
+                             concurrency=dict(initial=4, max_limit=10))
+        provider = self.gw.get_provider('limited')
+        limiter = provider.api.limiter
+
+        # Healthy: grows, no more than the limit in flight
+        inflight = []
+        def _api_request(method, **params):
+            inflight.append(limiter.inflight)
+            time.sleep(0.01)
+            return 'Credit: 1.0'
+        provider.api._api_request = _api_request
+        threads = [threading.Thread(target=provider.getbalance) for i in range(100)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(limiter.limit, 10)
+        self.assertLessEqual(max(inflight), 10)
+        self.assertEqual([reason for t, limit, reason in limiter.history], ['healthy'] * 6)
+
+        # Overload: cut once per round trip
+        provider.api._api_request = lambda method, **params: 'ERR: 130, Maximum MT limit exceeded'
+        started = [limiter.acquire() for i in range(5)]
+        for s in started:
+            limiter.release(s, failed=True, overload=True)
+        self.assertEqual(limiter.limit, 5)
+        self.assertRaises(error.E130, provider.api_request, 'sendmsg')
+        self.assertEqual(limiter.limit, 2)
+        self.assertEqual(limiter.history[-1][1:], (2, 'overload'))
+
+        # Valid error responses are not failures
+        self.assertTrue(limiter.is_overload(URLError(socket.timeout())))
+        self.assertTrue(limiter.is_overload(ClickatellApiError(901, 'Internal error')))
+        self.assertFalse(limiter.is_overload(ClickatellApiError(105, 'Invalid destination address')))
+
+        # Unroutable destinations do not cut the limit
+        limit, history = limiter.limit, len(limiter.history)
+        provider.api._api_request = lambda method, **params: 'ERR: 114, Cannot route message'
+        for dst in ('+111111', '+222222', '+333333'):
+            self.assertRaises(error.E114, self.gw.send, OutgoingMessage(dst, 'hey', provider='limited'))
+        self.assertEqual(limiter.limit, limit)
+        self.assertNotIn('overload', [reason for t, l, reason in list(limiter.history)[history:]])
+
+    def test_coverage(self):
+        """ Test the route coverage cache """
+        gw = self.gw
+        provider = gw.get_provider('main')
+        coverage = provider.coverage
+
+        requests = []
+        def _api_request(method, **params):
+            requests.append(method)
+            if method == 'routeCoverage':
+                if params['msisdn'].startswith('380'):
+                    return 'OK: This prefix is currently supported. Messages sent to this prefix will be routed. Charge: 1'
+                return 'ERR: This prefix is not currently supported. Messages sent to this prefix will not be routed.'
+            return 'ERR: 114, Cannot route message'
+        provider.api._api_request = _api_request
+
+        # Queries
+        self.assertTrue(coverage.query('380501234567'))
+        self.assertFalse(coverage.query('999001234567'))
+        self.assertEqual(coverage.lookup('380501999999'), 0)
+        self.assertEqual(coverage.lookup('380511999999'), None)
+        self.assertEqual(coverage.lookup('999001999999'), error.E114.code)
+
+        # Known unroutable: fails without a request
+        del requests[:]
+        self.assertRaises(error.E114, gw.send, OutgoingMessage('+999001111111', 'hey', provider='main'))
+        self.assertEqual(requests, [])
+
+        # Failures are remembered
+        self.assertRaises(error.E114, gw.send, OutgoingMessage('+123451111111', 'hey', provider='main'))
+        self.assertRaises(error.E114, gw.send, OutgoingMessage('+123451222222', 'hey', provider='main'))
+        self.assertEqual(requests, ['sendmsg'])
+        coverage.failed('380501111111', error.E105.code)
+        self.assertEqual(dict(coverage.classify(['380501111111', '380501222222', '123451000000', '5'])),
+                         {'380501111111': 105, '380501222222': 0, '123451000000': 114, '5': None})
+
+        # Expiration: expired nodes are pruned
+        coverage.trie.set('777', 0, time.time() - 1)
+        coverage.trie.set('77712', 0, time.time() - 1)
+        coverage.trie.set('7789', 0, time.time() + 60)
+        self.assertEqual(coverage.lookup('7771234567'), None)
+        self.assertEqual(coverage.trie._root['7']['7'].keys(), ['8'])
+        self.assertEqual(coverage.lookup('7789'), 0)
+
+    def test_blocklist(self):
+        """ Test the blocklist """
+        gw = self.gw
+        provider = gw.get_provider('main')
+
+        # Blocked on failure, no more requests
+        requests = []
+        def _api_request(method, **params):
+            requests.append(params['to'])
+            return 'ERR: 122, Destination mobile opted out'
+        provider.api._api_request = _api_request
+        self.assertRaises(error.E122, gw.send, OutgoingMessage('+123456', 'hey', provider='main'))
+        self.assertRaises(error.E122, gw.send, OutgoingMessage('+123456', 'hey', provider='main'))
+        self.assertEqual(requests, ['123456'])
+
+        # Buffer, merge, expiration, removal
+        blocklist = Blocklist(buffer_size=10)
+        for n in range(100, 125):
+            blocklist.add('380500000{}'.format(n), error.E121.code)
+        blocklist.add('380501111111', error.E128.code, expires=time.time() - 1)
+        blocklist.add('380502222222', error.E122.code, expires=time.time() + 60)
+        self.assertEqual(len(blocklist), 26)
+        self.assertEqual(blocklist.lookup('380500000110'), 121)
+        self.assertEqual(blocklist.lookup('380502222222'), 122)
+        self.assertNotIn('380501111111', blocklist)
+        self.assertNotIn('380500000099', blocklist)
+        blocklist.discard('380500000110')
+        self.assertNotIn('380500000110', blocklist)
+        self.assertEqual(len(blocklist), 25)
+
+        # Leading zeros make different numbers
+        blocklist.add('00441234567', error.E121.code)
+        blocklist.add('0501234567', error.E122.code)
+        blocklist.add('899999999999999', error.E128.code)
+        self.assertFalse(blocklist.add('1234567890123456', error.E121.code))
+        self.assertNotIn('441234567', blocklist)
+        self.assertNotIn('501234567', blocklist)
+        self.assertEqual(blocklist.lookup('00441234567'), 121)
+        self.assertEqual(blocklist.lookup('0501234567'), 122)
+        self.assertEqual(blocklist.lookup('899999999999999'), 128)
+        self.assertEqual(len(blocklist), 28)
+
+        # Import/Export
+        f = StringIO()
+        blocklist.dump(f)
+        f.seek(0)
+        imported = Blocklist()
+        imported.load(f)
+        self.assertEqual(imported.items(), blocklist.items())
+        self.assertIn(('00441234567', 121, 0), imported.items())
+
+        # Memory-mapped
+        path = tempfile.mktemp()
+        try:
+            blocklist.save(path)
+            mapped = MappedBlocklist(path)
+            self.assertEqual(len(mapped), 28)
+            self.assertEqual(mapped.lookup('380500000111'), 121)
+            self.assertEqual(mapped.lookup('00441234567'), 121)
+            self.assertIsNone(mapped.lookup('441234567'))
+            self.assertEqual(mapped.lookup('380502222222'), 122)
+            self.assertIsNone(mapped.lookup('380500000110'))
+            self.assertIsNone(mapped.lookup('999'))
+            self.assertIsNone(mapped.lookup('999999999999999'))
+            mapped.close()
+        finally:
+            os.unlink(path)
+
+    def test_scheduler(self):
+        """ Test priority lanes """
+        provider = self.gw.get_provider('main')
+        sent = []
+        def _api_request(method, **params):
+            sent.append(params['text'])
+            time.sleep(0.01)
+            return 'ID: 1'
+        provider.api._api_request = _api_request
+
+        scheduler = provider.scheduler(workers=2, lanes={
+            'high': dict(priority=0),
+            'normal': dict(priority=1, weight=3),
+            'low': dict(priority=1, weight=1, rate=1000),
+            'limited': dict(priority=2, concurrency=1),
+        })
+
+        # Bulk messages queued, then a high-priority one: it does not wait for them
+        normal = [scheduler.submit(OutgoingMessage('+123', 'normal')) for i in range(40)]
+        low = [scheduler.submit(OutgoingMessage('+123', 'low'), lane='low') for i in range(40)]
+        limited = [scheduler.submit(OutgoingMessage('+123', 'limited'), lane='limited') for i in range(5)]
+        high = scheduler.submit(OutgoingMessage('+123', 'otp').options(escalate=True))
+        self.assertEqual(high.result(timeout=5).msgid, '1')
+        self.assertGreater(sum(not j.done for j in normal), 30)
+        scheduler.close()
+
+        # Same priority: weights 3:1. Lower priority: last
+        self.assertTrue(all(j.done for j in normal + low + limited))
+        self.assertLess(sent.index('otp'), 5)
+        self.assertTrue(8 <= sent[:40].count('low') <= 12, sent)
+        self.assertEqual(sent[-5:], ['limited'] * 5)
+
+        # Metrics
+        metrics = scheduler.metrics()
+        self.assertEqual(metrics['high']['sent'], 1)
+        self.assertEqual(metrics['normal']['sent'], 40)
+        self.assertEqual(metrics['limited']['queued'], 0)
+        self.assertLess(metrics['high']['wait']['p99'], metrics['normal']['wait']['p99'])
+
+        # Custom lanes: the default lane is required, and used when there's no 'high' lane
+        self.assertRaises(AssertionError, provider.scheduler, lanes={'bulk': {}})
+        scheduler = provider.scheduler(lanes={'bulk': {}}, default='bulk')
+        self.assertEqual(scheduler.submit(OutgoingMessage('+123', 'otp').options(escalate=True)).lane.name, 'bulk')
+        self.assertRaises(AssertionError, scheduler.submit, OutgoingMessage('+123', 'hey'), lane='normal')
+        scheduler.close()
+
+        # Default lanes: bulk messages leave a worker for high-priority ones
+        release = threading.Event()
+        def _api_request(method, **params):
+            if params['text'] == 'bulk':
+                release.wait(5)
+            return 'ID: 1'
+        provider.api._api_request = _api_request
+        scheduler = provider.scheduler(workers=3)
+        self.assertEqual(scheduler.lanes['normal'].concurrency, 2)
+        bulk = [scheduler.submit(OutgoingMessage('+123', 'bulk')) for i in range(10)]
+        high = scheduler.submit(OutgoingMessage('+123', 'otp').options(escalate=True))
+        self.assertEqual(high.result(timeout=1).msgid, '1')
+        self.assertFalse(any(j.done for j in bulk))
+        release.set()
+        scheduler.close()
+        self.assertTrue(all(j.done for j in bulk))
+
+    def test_estimate_cost(self):
+        """ Test campaign cost estimation """
+        provider = self.gw.get_provider('main')
+        requests = []
+        def _api_request(method, **params):
+            requests.append(method)
+            return 'Credit: 100.0'
+        provider.api._api_request = _api_request
+
+        # Message parts: GSM 7-bit, UCS-2
+        self.assertEqual([message_parts('x' * n) for n in (150, 160, 161, 306, 307)], [1, 1, 2, 2, 3])
+        self.assertEqual([message_parts('{' * n) for n in (80, 81)], [1, 2])
+        self.assertEqual([message_parts(u'\u4e2d' * n) for n in (47, 70, 71, 134, 135)], [1, 1, 2, 2, 3])
+
+        long_text = 'x' * 200  # 2 parts
+        messages = [('380501234567', 'hey')] * 10 + [('380671234567', long_text)] * 10 + \
+                   [('11234567890', u'\u041f\u0440\u0438\u0432\u0435\u0442')] * 5 + [('999123', 'hey')] * 2
+        pricing = {'380': 1.0, '38067': 2.0, '1': 0.5}
+        expected = {
+            'messages': 27, 'parts': 37, 'credits': 10 * 1.0 + 20 * 2.0 + 5 * 0.5, 'unicode': 5, 'unpriced': 2,
+            'prefixes': {
+                '380': {'messages': 10, 'parts': 10, 'credits': 10.0},
+                '38067': {'messages': 10, 'parts': 20, 'credits': 40.0},
+                '1': {'messages': 5, 'parts': 5, 'credits': 2.5},
+                None: {'messages': 2, 'parts': 2, 'credits': 0.0},
+            },
+            'balance': 100.0, 'sufficient': True,
+        }
+
+        # Chunked, with and without numpy
+        numpy = cost.numpy
+        try:
+            for cost.numpy in set([numpy, None]):
+                self.assertEqual(CostEstimator(pricing, chunk_size=4).estimate(iter(messages), balance=100.0), expected)
+        finally:
+            cost.numpy = numpy
+
+        # Default price, balance is cached
+        estimate = provider.estimate_cost(messages, pricing, default=10.0)
+        self.assertEqual((estimate['unpriced'], estimate['credits'], estimate['sufficient']), (0, 72.5, True))
+        estimate = provider.estimate_cost(messages, pricing, default=20.0)
+        self.assertEqual((estimate['credits'], estimate['sufficient']), (92.5, True))
+        self.assertEqual(requests, ['getbalance'])
+
+    def test_session(self):
+        """ Test session authentication """
+        self.gw.add_provider('session', ClickatellProvider, api_id=10, user='kolypto', password='1234', session=True)
+        provider = self.gw.get_provider('session')
+
+        requests = []
+        sessions = ['s0']
+        lock = threading.Lock()
+        def _api_request(method, **params):
+            with lock:
+                requests.append((method, sorted(params.keys())))
+                if method == 'auth':
+                    time.sleep(0.05)
+                    sessions.append('s{}'.format(len(sessions)))
+                    return 'OK: ' + sessions[-1]
+                if params.get('session_id') != sessions[-1]:
+                    return 'ERR: 003, Session ID expired'
+            return 'Credit: 1.0'
+        provider.api._api_request = _api_request
+
+        # Authenticates once, then only sends the session id
+        nthreads = threading.active_count()
+        self.assertEqual(provider.getbalance(), 1.0)
+        self.assertEqual(provider.getbalance(), 1.0)
+        self.assertEqual(requests, [('auth', ['api_id', 'password', 'user']),
+                                    ('getbalance', ['session_id']),
+                                    ('getbalance', ['session_id'])])
+
+        # Session expires: a burst renews it once
+        del requests[:]
+        sessions.append('expired')
+        threads = [threading.Thread(target=provider.getbalance) for i in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([m for m, p in requests].count('auth'), 1)
+        self.assertEqual([m for m, p in requests].count('getbalance'), 20)
+
+        # Keepalive: started with the first session
+        del requests[:]
+        api = ClickatellHttpApi(10, 'kolypto', '1234', session=True, keepalive=0.1)
+        api._api_request = _api_request
+        provider.campaign()
+        self.assertEqual(threading.active_count(), nthreads + 1)  # the provider's one
+        api.getbalance()
+        self.assertEqual(threading.active_count(), nthreads + 2)
+        time.sleep(0.3)
+        api.close()
+        self.assertIn(('ping', ['session_id']), requests)
+        self.assertEqual(threading.active_count(), nthreads + 1)
+
+        # Authentication failure
+        provider.api._session_id = None
+        provider.api._api_request = lambda method, **params: 'ERR: 001, Authentication failed'
+        self.assertRaises(error.E001, provider.getbalance)
+        provider.close()
+        self.assertEqual(threading.active_count(), nthreads)
+
     def test_receive_message(self):
         """ Test message receipt """
 